@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of `ttable`.
+
+Tables are loaded end to end on SQLite. The SQL Server statements of
+`SystemVersionedTable` are compiled against the mssql dialect without a
+server.
+
+"""
+
+import datetime
+import sqlite3
+import luigi
+from luigi.contrib import sqla
+import pytest
+import sqlalchemy
+from sqlalchemy import Integer, VARCHAR
+from sqlalchemy.dialects import mssql
+import ttable
+
+
+class Source(luigi.ExternalTask):
+    url = luigi.Parameter()
+
+    def output(self):
+        return sqla.SQLAlchemyTarget(self.url, 'src', 'src')
+
+
+class Customers(ttable.SystemVersionedTable):
+    connection_string = luigi.Parameter(default='sqlite://')
+    table = 'customers'
+    columns = [(['code', Integer], {}), (['name', VARCHAR(20)], {})]
+    natural_key = ['code']
+    asof = luigi.DateParameter(default=datetime.date(2020, 1, 1))
+
+    def requires(self):
+        return Source(url=self.connection_string)
+
+
+class Dimension(ttable.TemporalTable):
+    connection_string = luigi.Parameter()
+    table = 'dim'
+    columns = [(['code', Integer], {}), (['name', VARCHAR(20)], {}),
+               (['lm', Integer], {})]
+    natural_key = ['code']
+    asof = luigi.DateParameter(default=datetime.date(2020, 1, 1))
+
+    def requires(self):
+        return Source(url=self.connection_string)
+
+
+class PartitionedDimension(Dimension):
+    # Partitions are run by worker processes from the class attributes
+    partitions = 2
+
+
+class PartitionedByName(PartitionedDimension):
+    natural_key = ['name']
+
+
+def _mssql_dialect(schema='sales'):
+    dialect = mssql.dialect()
+    dialect.default_schema_name = schema
+    return dialect
+
+
+def _stage(task):
+    """Binds the table of `task` and returns its staging table.
+    """
+    metadata = sqlalchemy.MetaData()
+    task.table_bound = sqlalchemy.Table(
+        task.table, metadata,
+        sqlalchemy.Column('id', Integer, primary_key=True),
+        *[sqlalchemy.Column(*c[0], **c[1]) for c in task.columns])
+    return sqlalchemy.Table(
+        '#stage_' + task.table, metadata,
+        *[sqlalchemy.Column(*c[0], **c[1]) for c in task.columns])
+
+
+def test_create_table_ddl():
+    sql = Customers()._create_table_ddl(_mssql_dialect())
+
+    assert sql.startswith('CREATE TABLE customers (\n'
+                          '    id INT IDENTITY PRIMARY KEY,\n'
+                          '    code INTEGER,\n'
+                          '    name VARCHAR(20),\n')
+    assert ('SysStartDate DATETIME2 GENERATED ALWAYS AS ROW START NOT NULL'
+            in sql)
+    assert 'SysEndDate DATETIME2 GENERATED ALWAYS AS ROW END NOT NULL' in sql
+    assert 'PERIOD FOR SYSTEM_TIME (SysStartDate, SysEndDate)' in sql
+    assert ('WITH (SYSTEM_VERSIONING = ON '
+            '(HISTORY_TABLE = sales.[customersHistory]));' in sql)
+    assert sql.endswith('CREATE INDEX ix_customers_code ON customers (code);')
+
+
+def test_create_table_ddl_history_table():
+    task = Customers()
+    task.history_table = 'customers_history'
+    sql = task._create_table_ddl(mssql.dialect())
+
+    # The dialect knows the default schema once connected
+    assert '(HISTORY_TABLE = dbo.customers_history)' in sql
+
+
+def test_merge_statement():
+    task = Customers()
+    sql = task._merge_statement(_mssql_dialect(), _stage(task))
+
+    assert sql == (
+        'MERGE INTO customers WITH (HOLDLOCK) AS t\n'
+        'USING [#stage_customers] AS s ON t.code = s.code\n'
+        'WHEN MATCHED AND (t.name != s.name OR '
+        't.name IS NULL AND s.name IS NOT NULL OR '
+        't.name IS NOT NULL AND s.name IS NULL) THEN\n'
+        '    UPDATE SET t.name = s.name\n'
+        'WHEN NOT MATCHED BY TARGET THEN\n'
+        '    INSERT (code, name) VALUES (s.code, s.name)\n'
+        'WHEN NOT MATCHED BY SOURCE THEN\n'
+        '    DELETE\n'
+        'OUTPUT $action;')
+
+
+def test_merge_statement_keeps_deleted_rows():
+    task = Customers()
+    task.obsolete_deleted_rows = False
+    sql = task._merge_statement(_mssql_dialect(), _stage(task))
+
+    assert 'NOT MATCHED BY SOURCE' not in sql
+    assert sql.endswith('VALUES (s.code, s.name)\nOUTPUT $action;')
+
+
+def _write_source(path, rows, columns='code INTEGER, name VARCHAR(20)'):
+    conn = sqlite3.connect(str(path))
+    conn.execute('DROP TABLE IF EXISTS src')
+    conn.execute('CREATE TABLE src ({})'.format(columns))
+    conn.executemany('INSERT INTO src VALUES ({})'.format(
+        ', '.join('?' * len(columns.split(',')))), rows)
+    conn.commit()
+    conn.close()
+
+
+def _write_dimension_source(path, rows):
+    _write_source(path, rows,
+                  'code INTEGER, name VARCHAR(20), lm INTEGER')
+
+
+def _current(path):
+    """Returns the (code, name) of the current versions of `dim`.
+    """
+    conn = sqlite3.connect(str(path))
+    rows = conn.execute("SELECT code, name FROM dim "
+                        "WHERE SysEndDate = '2999-12-31' "
+                        "ORDER BY code, name").fetchall()
+    conn.close()
+    return rows
+
+
+def _snapshot(task, date):
+    frame = task.as_of(date)
+    return sorted(zip(frame['code'], frame['name']))
+
+
+def test_set_based_fallback(tmp_path):
+    path = tmp_path / 'customers.db'
+    url = 'sqlite:///{}'.format(path)
+    first, second = datetime.date(2020, 1, 1), datetime.date(2020, 1, 2)
+
+    _write_source(path, [(1, 'Ann'), (2, 'Bob'), (3, 'Cid')])
+    Customers(connection_string=url, asof=first).run()
+
+    _write_source(path, [(1, 'Ann'), (2, 'Bea'), (4, 'Dan')])
+    task = Customers(connection_string=url, asof=second)
+    task.run()
+
+    assert _snapshot(task, first) == [(1, 'Ann'), (2, 'Bob'), (3, 'Cid')]
+    assert _snapshot(task, second) == [(1, 'Ann'), (2, 'Bea'), (4, 'Dan')]
+    assert task.metrics.inserted == 2
+    assert task.metrics.expired == 2
+    assert task.metrics.unchanged == 1
+    assert task.metrics.phases['stage']['rows'] == 3
+
+    history = task.history(2)
+    assert list(history['name']) == ['Bob', 'Bea']
+    assert list(history['SysEndDate']) == [second, task.enddate]
+
+
+def test_set_based_rejects_null_keys(tmp_path):
+    path = tmp_path / 'dim.db'
+    _write_dimension_source(path, [(1, 'Ann', 1), (None, 'Bob', 1)])
+    task = Dimension(connection_string='sqlite:///{}'.format(path))
+    task.set_based = True
+
+    with pytest.raises(ValueError, match='NULL natural key'):
+        task.run()
+
+
+def test_pandas_hash_is_typed():
+    task = Dimension(connection_string='sqlite://')
+    task.hash_algorithm = 'pandas'
+    rows = [dict(code=1, name='1', lm=1), dict(code='1', name='1', lm=1),
+            dict(code=1, name=None, lm=1), dict(code=1, name='nan', lm=1),
+            dict(code=1.0, name='1', lm=True)]
+    digests = task._digest_rows(rows)
+
+    assert len(set(digests[:4])) == 4
+    assert digests[4] == digests[0]
+    # Digests don't depend on the other rows of the chunk
+    assert task._digest_rows(rows[:1]) == digests[:1]
+
+
+def test_watermark_reads_rows_at_the_watermark(tmp_path):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    _write_dimension_source(path, [(1, 'Ann', 1), (2, 'Bob', 2)])
+    task = Dimension(connection_string=url)
+    task.watermark_column = 'lm'
+    task.run()
+
+    # Cid arrives with the watermark value of the last run
+    _write_dimension_source(path, [(1, 'Ann', 1), (2, 'Bob', 2),
+                                   (3, 'Cid', 2)])
+    task = Dimension(connection_string=url, asof=datetime.date(2020, 1, 2))
+    task.watermark_column = 'lm'
+    task.run()
+
+    assert task.watermark == 2
+    assert _current(path) == [(1, 'Ann'), (2, 'Bob'), (3, 'Cid')]
+    assert task.metrics.inserted == 1
+    assert task.metrics.unchanged == 1
+
+
+def test_merge_diff(tmp_path):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    _write_dimension_source(path, [(1, 'Ann', 1), (2, 'Bob', 1),
+                                   (3, 'Cid', 1)])
+    Dimension(connection_string=url).run()
+
+    _write_dimension_source(path, [(1, 'Ann', 1), (2, 'Bea', 2),
+                                   (4, 'Dan', 2)])
+    task = Dimension(connection_string=url, asof=datetime.date(2020, 1, 2))
+    task.merge_diff = True
+    task.run()
+
+    assert _current(path) == [(1, 'Ann'), (2, 'Bea'), (4, 'Dan')]
+    assert task.metrics.inserted == 2
+    assert task.metrics.expired == 2
+    assert task.metrics.unchanged == 1
+
+
+def test_merge_diff_rejects_null_keys(tmp_path):
+    path = tmp_path / 'dim.db'
+    _write_dimension_source(path, [(1, 'Ann', 1), (None, 'Bob', 1)])
+    task = Dimension(connection_string='sqlite:///{}'.format(path))
+    task.merge_diff = True
+    task.bootstrap = False
+
+    with pytest.raises(ValueError, match='NULL natural key'):
+        task.run()
+
+
+def test_bootstrap_only_empty_tables(tmp_path, monkeypatch):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    _write_dimension_source(path, [(1, 'Ann', 1)])
+    Dimension(connection_string=url).run()
+    _write_dimension_source(path, [])
+    Dimension(connection_string=url, asof=datetime.date(2020, 1, 2)).run()
+    assert _current(path) == []
+
+    def bootstrap(task, conn):
+        raise AssertionError('bootstrapped a table with versions')
+    monkeypatch.setattr(Dimension, '_run_bootstrap', bootstrap)
+
+    _write_dimension_source(path, [(1, 'Ann', 1)])
+    Dimension(connection_string=url, asof=datetime.date(2020, 1, 3)).run()
+    assert _current(path) == [(1, 'Ann')]
+
+
+def test_checkpointed_run_resumes_after_failure(tmp_path, monkeypatch):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    _write_dimension_source(path, [(i, 'n{}'.format(i), 1)
+                                   for i in range(10)])
+    Dimension(connection_string=url).run()
+
+    rows = [(i, 'n{}'.format(i) if i % 3 else 'x{}'.format(i), 2)
+            for i in range(2, 12)]
+    _write_dimension_source(path, rows)
+    task = Dimension(connection_string=url, asof=datetime.date(2020, 1, 2))
+    task.commit_every = 1
+    task.chunksize = 2
+
+    write_checkpoint = ttable.TemporalTable._write_checkpoint
+
+    def failing(self, conn, checkpoint, commits):
+        if commits == 2:
+            raise RuntimeError('failed')
+        write_checkpoint(self, conn, checkpoint, commits)
+    monkeypatch.setattr(Dimension, '_write_checkpoint', failing)
+    with pytest.raises(RuntimeError, match='failed'):
+        task.run()
+
+    monkeypatch.undo()
+    task.run()
+
+    assert _current(path) == [(code, name) for code, name, lm in rows]
+
+
+@pytest.mark.parametrize('cls', [PartitionedDimension, PartitionedByName])
+def test_partitions_with_null_keys(tmp_path, cls):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    _write_dimension_source(path, [(None, 'Ann', 1), (1, None, 1),
+                                   (2, 'Bob', 1), (3, 'Cid', 1)])
+    cls(connection_string=url).run()
+    task = cls(connection_string=url, asof=datetime.date(2020, 1, 2))
+    task.run()
+
+    assert _current(path) == [(None, 'Ann'), (1, None), (2, 'Bob'),
+                              (3, 'Cid')]
+    assert task.metrics.inserted == 0
+    assert task.metrics.expired == 0
+    assert task.metrics.unchanged == 4
+
+
+def test_pipeline(tmp_path):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    _write_dimension_source(path, [(1, 'Ann', 1), (2, 'Bob', 1),
+                                   (3, 'Cid', 1)])
+    Dimension(connection_string=url).run()
+
+    _write_dimension_source(path, [(1, 'Ann', 1), (2, 'Bea', 2),
+                                   (4, 'Dan', 2)])
+    task = Dimension(connection_string=url, asof=datetime.date(2020, 1, 2))
+    task.pipeline = True
+    task.chunksize = 1
+    task.run()
+
+    assert _current(path) == [(1, 'Ann'), (2, 'Bea'), (4, 'Dan')]
+    assert task.metrics.inserted == 2
+    assert task.metrics.expired == 2
+    assert task.metrics.unchanged == 1
+
+
+@pytest.mark.parametrize('set_based', [False, True])
+def test_max_delete_fraction(tmp_path, set_based):
+    path = tmp_path / 'dim.db'
+    url = 'sqlite:///{}'.format(path)
+    rows = [(1, 'Ann', 1), (2, 'Bob', 1), (3, 'Cid', 1), (4, 'Dan', 1)]
+    _write_dimension_source(path, rows)
+    Dimension(connection_string=url).run()
+
+    _write_dimension_source(path, [(1, 'Ann', 1)])
+    task = Dimension(connection_string=url, asof=datetime.date(2020, 1, 2))
+    task.set_based = set_based
+    task.max_delete_fraction = 0.5
+    with pytest.raises(RuntimeError, match='max_delete_fraction'):
+        task.run()
+
+    assert _current(path) == [(code, name) for code, name, lm in rows]
@@ -14,221 +14,2782 @@ without complex ETL implementation.
 
 """
 
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import contextlib
 import datetime
+import decimal
 import hashlib
+import io
 import itertools
+import json
+import logging
+import multiprocessing
+import numbers
+import os
+import queue
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer
+import numpy as np
 import pandas as pd
 import sqlalchemy
 from sqlalchemy import TEXT, Integer, Float, REAL, Date, Index, VARCHAR
-from sqlalchemy.orm import Session
 import luigi
 from luigi.contrib import sqla
+from timer import Timer
+
+logger = logging.getLogger(__name__)
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Columns maintained by `TemporalTable` that are not part of the input rows
+SYSTEM_COLUMNS = ('id', 'SysStartDate', 'SysEndDate', 'RowHash')
+
+# Hash algorithms computed on whole chunks of rows at once, see
+# `TemporalTable._digest_frame`
+FRAME_HASH_ALGORITHMS = ('pandas',)
+
+# Combines the hashes of the columns of a frame, see `_hash_array`
+_HASH_MULTIPLIER = np.uint64(0x100000001b3)
+
+
+def _blake2b(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _builtin(data):
+    return hash(data).to_bytes(8, 'little', signed=True)
+
+
+# Functions that map the encoded row to a compact binary digest. Algorithms
+# not registered here are looked up in `hashlib`.
+HASH_BACKENDS = {
+    'blake2b': _blake2b,
+    'builtin': _builtin,
+}
+
+if xxhash is not None:
+    HASH_BACKENDS['xxh64'] = lambda data: xxhash.xxh64(data).digest()
+    HASH_BACKENDS['xxh128'] = lambda data: xxhash.xxh3_128(data).digest()
+
+# The builtin hash of bytes is salted per process, so these digests can't
+# be stored in the `RowHash` column.
+UNSTABLE_HASH_ALGORITHMS = ('builtin',)
+
+
+# Fields of the canonical row encoding, see `TemporalTable._encode_row`.
+# Each value is a one byte tag followed by a fixed-width payload or, for
+# variable-width payloads, their length and the payload.
+_NULL_FIELD = b'N'
+_INT_FIELD = struct.Struct('>cq')
+_FLOAT_FIELD = struct.Struct('>cd')
+_DATE_FIELD = struct.Struct('>ci')
+_BOOL_FIELD = struct.Struct('>c?')
+_LENGTH_FIELD = struct.Struct('>cI')
+
+# Errors raised by the encoders of values that don't match their column
+# type, which are then encoded as text
+_ENCODING_ERRORS = (TypeError, ValueError, ArithmeticError, AttributeError,
+                    struct.error)
+
+
+def _integral(value):
+    if not isinstance(value, int):
+        integral = int(value)
+        if integral != value:
+            raise ValueError('{!r} is not an integer'.format(value))
+        value = integral
+    return value
+
+
+def _encode_int(value):
+    return _INT_FIELD.pack(b'I', _integral(value))
+
+
+def _encode_float(value):
+    return _FLOAT_FIELD.pack(b'F', float(value))
+
+
+def _encode_bool(value):
+    return _BOOL_FIELD.pack(b'B', bool(value))
+
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _encode_date(value):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return _DATE_FIELD.pack(b'D', value.toordinal())
+
+
+def _encode_datetime(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    microseconds = ((value.toordinal() * 86400 + value.hour * 3600 +
+                     value.minute * 60 + value.second) * 1000000 +
+                    value.microsecond)
+    return _INT_FIELD.pack(b'T', microseconds)
+
+
+def _encode_time(value):
+    microseconds = ((value.hour * 3600 + value.minute * 60 + value.second) *
+                    1000000 + value.microsecond)
+    return _INT_FIELD.pack(b't', microseconds)
+
+
+def _encode_text(value):
+    data = str(value).encode('utf-8')
+    return _LENGTH_FIELD.pack(b'S', len(data)) + data
+
+
+def _encode_bytes(value):
+    return _LENGTH_FIELD.pack(b'X', len(value)) + bytes(value)
+
+
+def _decimal(value):
+    if isinstance(value, decimal.Decimal):
+        return value
+    if isinstance(value, float):
+        # The shortest repr, not the binary expansion of the float
+        return decimal.Decimal(repr(value))
+    return decimal.Decimal(value)
+
+
+def _numeric_encoder(scale):
+    """Returns the encoder of a `Numeric` column with `scale` decimals.
+
+    Values are rounded to `scale` and encoded as a scaled 64-bit integer,
+    or as normalized text if the scale is unknown or the value too large.
+
+    """
+    def encode(value):
+        value = _decimal(value)
+        if scale is not None:
+            scaled = value.scaleb(scale).to_integral_value(
+                decimal.ROUND_HALF_UP)
+            if -2 ** 63 <= scaled < 2 ** 63:
+                return _INT_FIELD.pack(b'M', int(scaled))
+        data = str(value.normalize()).encode('ascii')
+        return _LENGTH_FIELD.pack(b'm', len(data)) + data
+    return encode
+
+
+def column_encoder(type_):
+    """Returns the function that encodes the values of a column of
+    SQLAlchemy type `type_` for the canonical row encoding.
+    """
+    if isinstance(type_, sqlalchemy.Boolean):
+        return _encode_bool
+    if isinstance(type_, Integer):
+        return _encode_int
+    if isinstance(type_, Float):
+        return _encode_float
+    if isinstance(type_, sqlalchemy.Numeric):
+        return _numeric_encoder(type_.scale)
+    if isinstance(type_, sqlalchemy.DateTime):
+        return _encode_datetime
+    if isinstance(type_, Date):
+        return _encode_date
+    if isinstance(type_, sqlalchemy.Time):
+        return _encode_time
+    if isinstance(type_, sqlalchemy.LargeBinary):
+        return _encode_bytes
+    return _encode_text
+
+
+def _frame_column(values, type_):
+    """Returns the arrays hashed for a column of SQLAlchemy type `type_` by
+    the 'pandas' hash algorithm.
+
+    Integer, float and date columns are converted to numeric arrays and
+    text columns are kept as is. The second array holds a NULL marker or,
+    for values that don't fit the column type and for the other column
+    types, the canonical encoding of the value, so that equal values hash
+    the same whatever the other values of the chunk.
+
+    Args:
+        values (numpy.ndarray): Values of the column, as Python objects.
+        type_ (sqlalchemy.types.TypeEngine): Type of the column, or None.
+
+    Returns:
+        tuple: The typed array and the object array of markers.
+
+    """
+    null = np.equal(values, None)
+    extra = np.full(len(values), None, dtype=object)
+    extra[null] = _NULL_FIELD
+
+    if isinstance(type_, Integer):
+        dtype, kinds, convert = 'int64', ('integer',), _integral
+    elif isinstance(type_, Float):
+        dtype, kinds, convert = (
+            'float64', ('integer', 'floating', 'mixed-integer-float'), float)
+    elif isinstance(type_, Date):
+        dtype, kinds, convert = 'datetime64[D]', ('date',), _epoch_days
+    elif type_ is None or isinstance(type_, sqlalchemy.String):
+        return values, extra
+    else:
+        dtype, kinds, convert = None, (), None
+
+    if pd.api.types.infer_dtype(values, skipna=True) in kinds + ('empty',):
+        filled = values.copy()
+        filled[null] = 0 if dtype != 'datetime64[D]' else None
+        try:
+            return np.asarray(filled, dtype=dtype).view('<u8'), extra
+        except OverflowError:
+            pass
+
+    # Converted one by one, values that don't convert are encoded as by
+    # `_encode_row`
+    typed = np.zeros(len(values), dtype='<u8')
+    encode = column_encoder(type_)
+    for i in np.flatnonzero(~null):
+        value = values[i]
+        if convert is not None:
+            try:
+                typed[i] = np.asarray(convert(value), dtype).view('<u8')
+                continue
+            except _ENCODING_ERRORS:
+                pass
+        try:
+            extra[i] = encode(value)
+        except _ENCODING_ERRORS:
+            extra[i] = _encode_text(value)
+    return typed, extra
+
+
+def _hash_array(values, hash_key):
+    """Hashes each value of an array of `_frame_column`, None to 0.
+    """
+    if values.dtype != object:
+        return pd.util.hash_array(values, hash_key=hash_key)
+    hashes = np.zeros(len(values), dtype='<u8')
+    present = np.not_equal(values, None)
+    if present.any():
+        hashes[present] = pd.util.hash_array(values[present],
+                                             hash_key=hash_key,
+                                             categorize=False)
+    return hashes
+
+
+def _epoch_days(value):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.toordinal() - _EPOCH_ORDINAL
+
+
+# `TemporalTable` methods used to bulk load rows, by dialect and driver.
+# SQLite has none: its executemany is faster than multi-row `VALUES`, which
+# can still be chosen with `BULK_LOADERS[('sqlite', 'pysqlite')] =
+# '_load_multirow'`.
+BULK_LOADERS = {
+    ('mssql', 'pyodbc'): '_load_fast_executemany',
+    ('postgresql', 'psycopg2'): '_load_copy',
+}
+
+
+def _csv_value(value):
+    """Formats a value for PostgreSQL `COPY ... WITH CSV`.
+
+    NULL is an unquoted empty field, everything else is quoted so that empty
+    strings are kept.
+
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, bytes):
+        value = '\\x' + value.hex()
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+
+def _json_default(value):
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'__time__': value.isoformat()}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'__bytes__': bytes(value).hex()}
+    raise TypeError('{!r} can not be stored as JSON'.format(value))
+
+
+# Decoders of the values `_json_default` stores as single key objects
+_JSON_TYPES = {
+    '__decimal__': decimal.Decimal,
+    '__datetime__': datetime.datetime.fromisoformat,
+    '__date__': datetime.date.fromisoformat,
+    '__time__': datetime.time.fromisoformat,
+    '__bytes__': bytes.fromhex,
+}
+
+
+def _json_object(obj):
+    if len(obj) == 1:
+        name, value = next(iter(obj.items()))
+        if name in _JSON_TYPES:
+            return _JSON_TYPES[name](value)
+    return obj
+
+
+def _dump_json(value):
+    """Serializes a natural key or watermark value as JSON, with tagged
+    objects for the types JSON lacks, see `_load_json`.
+    """
+    return json.dumps(value, default=_json_default)
+
+
+def _load_json(text):
+    """Deserializes a value serialized by `_dump_json`.
+    """
+    if text is None:
+        return None
+    return json.loads(text, object_hook=_json_object)
+
+
+def _partition_worker(args):
+    """Runs one partition of a `TemporalTable` in a worker process.
+    """
+    cls, param_kwargs, partition = args
+    return cls(**param_kwargs)._run_partition(partition)
+
+
+def _batch_worker(args):
+    """Runs a `TemporalTable` task of `run_batch` in a worker process.
+
+    Returns:
+        dict: `RunMetrics.as_dict` of the run, or None if the task was
+            already complete.
+
+    """
+    cls, param_kwargs = args
+    task = cls(**param_kwargs)
+    if task.complete():
+        return None
+    task.run()
+    return task.metrics.as_dict()
+
+
+# Reflected tables by connection string, shared by the tasks run in a
+# process, see `reflected_table`
+_METADATA = dict()
+_METADATA_LOCK = threading.Lock()
+
+
+def reflected_table(bind, name):
+    """Returns the table `name` of the database of `bind`.
+
+    Tables are reflected once per process and connection string into a
+    shared `MetaData`, so tasks run in the same process don't reflect them
+    again. Only used for the tables `TemporalTable` creates and maintains
+    itself: input tables may be rebuilt by upstream tasks between runs, see
+    `TemporalTable._input_table`. See `clear_reflected_tables`.
+
+    Args:
+        bind: The sqlalchemy engine or connection.
+        name (str): Name of the table.
+
+    """
+    with _METADATA_LOCK:
+        metadata = _METADATA.setdefault(str(bind.engine.url),
+                                        sqlalchemy.MetaData())
+        if name not in metadata.tables:
+            metadata.reflect(bind=bind, only=[name])
+        return metadata.tables[name]
+
+
+def clear_reflected_tables():
+    """Forgets the tables reflected by `reflected_table`, e.g. after their
+    schema changed.
+    """
+    with _METADATA_LOCK:
+        _METADATA.clear()
+
+
+# Marks the end of the items of a pipeline queue
+_END = object()
+
+
+def _pipe_put(items, item, stop):
+    """Puts `item` on the bounded queue `items`, giving up once `stop` is
+    set.
+
+    Returns:
+        bool: True if the item was queued.
+
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _pipe_get(items, stop):
+    """Gets the next item of the queue `items`, or `_END` once `stop` is
+    set.
+    """
+    while not stop.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def register_hash_backend(name, function):
+    """Registers a hash backend selectable with `hash_algorithm`.
+
+    Args:
+        name (str): Name of the algorithm.
+        function (callable): Function that takes the encoded row as bytes
+            and returns its digest as bytes.
+
+    """
+    HASH_BACKENDS[name] = function
+
+
+def _encode_key_value(value):
+    """Encodes a natural key value for `key_hash`.
+
+    Values that compare equal in Python encode alike whatever their type,
+    e.g. 1, 1.0 and Decimal('1'), so a key read from a REAL source column
+    finds its version in an INTEGER target column.
+
+    """
+    if value is None:
+        return _NULL_FIELD
+    if isinstance(value, (numbers.Real, decimal.Decimal)):
+        try:
+            return _encode_int(value)
+        except _ENCODING_ERRORS:
+            # Not integral, not finite or too large for 64 bits
+            data = str(_decimal(value).normalize()).encode('ascii')
+            return _LENGTH_FIELD.pack(b'm', len(data)) + data
+    if isinstance(value, datetime.datetime):
+        return _encode_datetime(value)
+    if isinstance(value, datetime.date):
+        return _encode_date(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _encode_bytes(value)
+    return _encode_text(value)
+
+
+def key_hash(key):
+    """Hashes a natural key tuple to a 64-bit unsigned integer.
+
+    The values are hashed with a type-normalized encoding, see
+    `_encode_key_value`.
+
+    """
+    data = b''.join(_encode_key_value(value) for value in key)
+    digest = hashlib.blake2b(data, digest_size=8)
+    return int.from_bytes(digest.digest(), 'little')
+
+
+class KeyHashCollision(ValueError):
+    """Raised by the caches that store `key_hash` instead of the natural
+    keys when two cached keys have the same hash.
+    """
+
+
+def max_rss():
+    """Returns the peak resident set size of the process in bytes, or None
+    where the `resource` module isn't available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class KeyCache(object):
+    """Hash and id of the current version of each natural key.
+
+    This is the default cache, backed by Python dicts and a set.
+
+    """
+    # Rough memory footprint of a cached key, used to pick a cache that
+    # fits `TemporalTable.memory_budget`
+    bytes_per_key = 400
+
+    def __init__(self):
+        self.hashes = dict()
+        self.ids = dict()
+        self.seen = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, key, id, digest):
+        """Adds the current version of `key` to the cache.
+        """
+        self.hashes[key] = digest
+        self.ids[key] = id
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the cache, in bytes.
+
+        The dicts and set are measured, keys and digests are sized after the
+        first cached key.
+
+        """
+        size = sum(sys.getsizeof(c) for c in (self.hashes, self.ids,
+                                              self.seen))
+        if self.hashes:
+            key, digest = next(iter(self.hashes.items()))
+            size += len(self.hashes) * (
+                sys.getsizeof(key) + sys.getsizeof(digest) +
+                sum(sys.getsizeof(value) for value in key))
+        return size
+
+    def freeze(self):
+        """Called once all current versions were added.
+        """
+        pass
+
+    def close(self):
+        """Releases the resources held by the cache.
+        """
+        pass
+
+    def visit(self, key):
+        """Marks `key` as seen in the input.
+
+        Returns:
+            tuple: (id, digest) of the current version, or None if `key` is
+                not in the cache.
+
+        """
+        if key not in self.ids:
+            return None
+        self.seen.add(key)
+        return self.ids[key], self.hashes[key]
+
+    def visit_many(self, keys):
+        """Marks a batch of keys as seen in the input.
+
+        Returns:
+            tuple: (found, ids, digests), where `found` is a boolean array
+                flagging the keys in the cache, and `ids` and `digests` hold
+                the id and digest of the current version of the found keys.
+
+        """
+        found = np.zeros(len(keys), dtype=bool)
+        ids, digests = list(), list()
+        for i, key in enumerate(keys):
+            cached = self.visit(key)
+            if cached is not None:
+                found[i] = True
+                ids.append(cached[0])
+                digests.append(cached[1])
+        return found, ids, digests
+
+    def unseen_ids(self):
+        """Returns the ids of the current versions not seen in the input.
+        """
+        ids = self.ids
+        return [ids[key] for key in ids.keys() - self.seen]
+
+
+class CompactKeyCache(object):
+    """Array-backed replacement of `KeyCache` for very large tables.
+
+    Keys are stored as 64-bit hashes (see `key_hash`), digests as raw bytes
+    and the seen flags as a bitset, all in NumPy arrays sorted by key hash.
+    That takes about `16 + digest size` bytes per key instead of the
+    hundreds of bytes of the dict entries, tuples and strings.
+
+    """
+    bytes_per_key = 64
+
+    def __init__(self):
+        self.digest_size = None
+        self._keys = array('Q')
+        self._ids = array('q')
+        self._digests = bytearray()
+
+    def __len__(self):
+        if self._digests is None:
+            return len(self.keys)
+        return len(self._keys)
+
+    def add(self, key, id, digest):
+        """Adds the current version of `key` to the cache.
+        """
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        self._keys.append(key_hash(key))
+        self._ids.append(id)
+        self._digests += digest
+
+    @property
+    def nbytes(self):
+        """Memory used by the cache arrays, in bytes.
+        """
+        if self._digests is not None:
+            # Not frozen yet, the data is in the growable buffers
+            return (len(self._keys) * self._keys.itemsize +
+                    len(self._ids) * self._ids.itemsize + len(self._digests))
+        return sum(a.nbytes for a in (self.keys, self.ids, self.digests,
+                                      self.seen))
+
+    def freeze(self):
+        """Sorts the arrays by key hash, making the cache searchable.
+
+        Raises:
+            KeyHashCollision: If two cached keys have the same hash.
+
+        """
+        keys = np.frombuffer(self._keys, dtype=np.uint64)
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        if (self.keys[1:] == self.keys[:-1]).any():
+            raise KeyHashCollision('Two cached natural keys have the same '
+                                   'key hash')
+        self.ids = np.frombuffer(self._ids, dtype=np.int64)[order]
+        self.digests = np.frombuffer(
+            bytes(self._digests),
+            dtype='V{}'.format(self.digest_size or 1))[order]
+        self.seen = np.zeros((len(self.keys) + 7) // 8, dtype=np.uint8)
+
+        # Growable buffers are no longer needed
+        self._keys, self._ids, self._digests = array('Q'), array('q'), None
+
+    def close(self):
+        """Releases the resources held by the cache.
+        """
+        pass
+
+    def _find(self, key):
+        """Position of `key` in the sorted arrays, or -1 if not found.
+        """
+        h = key_hash(key)
+        i = int(np.searchsorted(self.keys, h))
+        if i < len(self.keys) and self.keys[i] == h:
+            return i
+        return -1
+
+    def visit(self, key):
+        """Marks `key` as seen in the input.
+
+        Returns:
+            tuple: (id, digest) of the current version, or None if `key` is
+                not in the cache.
+
+        """
+        i = self._find(key)
+        if i < 0:
+            return None
+        self.seen[i >> 3] |= 1 << (i & 7)
+        return int(self.ids[i]), self.digests[i].tobytes()
+
+    def visit_many(self, keys):
+        """Marks a batch of keys as seen in the input.
+
+        The keys are searched and flagged with array operations.
+
+        Returns:
+            tuple: (found, ids, digests), where `found` is a boolean array
+                flagging the keys in the cache, and `ids` and `digests` hold
+                the id and digest of the current version of the found keys.
+
+        """
+        hashes = np.fromiter((key_hash(key) for key in keys),
+                             dtype=np.uint64, count=len(keys))
+        positions = np.searchsorted(self.keys, hashes)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == hashes[found]
+
+        positions = positions[found]
+        np.bitwise_or.at(self.seen, positions >> 3,
+                         (1 << (positions & 7)).astype(np.uint8))
+        return (found, self.ids[positions].tolist(),
+                [digest.tobytes() for digest in self.digests[positions]])
+
+    def unseen_ids(self):
+        """Returns the ids of the current versions not seen in the input.
+        """
+        seen = np.unpackbits(self.seen, bitorder='little')[:len(self.keys)]
+        return self.ids[seen == 0].tolist()
+
+
+class DiskKeyCache(object):
+    """`KeyCache` replacement that spills the cache to a local SQLite file.
+
+    Lookups go through an in-memory LRU of `lru_size` entries; inserts and
+    seen flags are written to the file in batches. Memory use is bounded by
+    the LRU size whatever the number of keys.
+
+    Args:
+        lru_size (Optional[int]): Number of entries kept in memory.
+            Defaults to 100000.
+        batch_size (Optional[int]): Number of writes sent to the file at a
+            time. Defaults to 10000.
+
+    """
+    def __init__(self, lru_size=100000, batch_size=10000):
+        self.lru_size = lru_size
+        self.batch_size = batch_size
+        self._lru = OrderedDict()
+        self._added = list()
+        self._seen = list()
+
+        self._dir = tempfile.mkdtemp(prefix='ttable_cache_')
+        # The cache is filled and read by different threads of a pipelined
+        # run, one at a time
+        self._db = sqlite3.connect(os.path.join(self._dir, 'cache.db'),
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE cache (key INTEGER PRIMARY KEY, '
+                         'id INTEGER, digest BLOB, seen INTEGER DEFAULT 0)')
+
+    def __len__(self):
+        self._flush()
+        return self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    @staticmethod
+    def _key(key):
+        """`key_hash` as the signed 64-bit integer SQLite stores.
+        """
+        h = key_hash(key)
+        return h - (1 << 64) if h >= 1 << 63 else h
+
+    def _flush(self):
+        if self._added:
+            try:
+                self._db.executemany('INSERT INTO cache (key, id, digest) '
+                                     'VALUES (?, ?, ?)', self._added)
+            except sqlite3.IntegrityError:
+                raise KeyHashCollision('Two cached natural keys have the '
+                                       'same key hash')
+            self._added = list()
+        if self._seen:
+            self._db.executemany('UPDATE cache SET seen = 1 WHERE key = ?',
+                                 self._seen)
+            self._seen = list()
+
+    def add(self, key, id, digest):
+        """Adds the current version of `key` to the cache.
+        """
+        self._added.append((self._key(key), id, digest))
+        if len(self._added) >= self.batch_size:
+            self._flush()
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the LRU and the pending writes, in
+        bytes. The cache file isn't counted.
+        """
+        size = sum(sys.getsizeof(c) for c in (self._lru, self._added,
+                                              self._seen))
+        for entry in itertools.islice(self._lru.values(), 1):
+            size += len(self._lru) * sys.getsizeof(entry)
+        return size
+
+    def freeze(self):
+        """Called once all current versions were added.
+
+        Raises:
+            KeyHashCollision: If two cached keys have the same hash.
+
+        """
+        self._flush()
+        self._db.commit()
+
+    def visit(self, key):
+        """Marks `key` as seen in the input.
+
+        Returns:
+            tuple: (id, digest) of the current version, or None if `key` is
+                not in the cache.
+
+        """
+        h = self._key(key)
+        if h in self._lru:
+            self._lru.move_to_end(h)
+            cached = self._lru[h]
+        else:
+            cached = self._db.execute('SELECT id, digest FROM cache '
+                                      'WHERE key = ?', (h,)).fetchone()
+            self._lru[h] = cached
+            if len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+        if cached is None:
+            return None
+        self._seen.append((h,))
+        if len(self._seen) >= self.batch_size:
+            self._flush()
+        return cached[0], bytes(cached[1])
+
+    def visit_many(self, keys):
+        """Marks a batch of keys as seen in the input.
+
+        Returns:
+            tuple: (found, ids, digests), see `KeyCache.visit_many`.
+
+        """
+        return KeyCache.visit_many(self, keys)
+
+    def unseen_ids(self):
+        """Returns the ids of the current versions not seen in the input.
+        """
+        self._flush()
+        return [id for id, in
+                self._db.execute('SELECT id FROM cache WHERE seen = 0')]
+
+    def close(self):
+        """Closes and deletes the cache file.
+        """
+        self._db.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class RunMetrics(object):
+    """Time and row counts of the phases of a `TemporalTable` run.
+
+    Phases are timed with `phase`. The time of a phase nested in another is
+    only counted in the inner phase, so phase times add up to the run time:
+    e.g. 'prefill' doesn't include the 'hash' time of the current versions.
+    Phases run by the threads of a pipelined run overlap, and their CPU
+    time is the time of the thread that ran them.
+
+    Attributes:
+        phases (OrderedDict): Name of each phase to a dict with its `wall`
+            and `cpu` seconds, the number of `rows` it processed and
+            `max_rss`, the peak RSS of the process when the phase last
+            ended, see `max_rss`.
+        inserted (int): Row versions inserted.
+        expired (int): Row versions set as obsolete.
+        unchanged (int): Input rows identical to their current version.
+        cache_bytes (int): Peak memory used by the cache, see `sample_cache`.
+
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.inserted = 0
+        self.expired = 0
+        self.unchanged = 0
+        self.cache_bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = default_timer()
+        self._cpu_start = time.process_time()
+
+    def _stats(self, name):
+        return self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0,
+                                             'rows': 0, 'max_rss': None})
+
+    @contextlib.contextmanager
+    def phase(self, name, rows=0):
+        """Context manager that adds the time of its block to phase `name`.
+
+        Args:
+            name (str): Name of the phase.
+            rows (Optional[int]): Rows processed by the block. Defaults to 0,
+                see `add_rows`.
+
+        """
+        # Time of the phases nested in this one, by thread
+        nested = getattr(self._local, 'nested', None)
+        if nested is None:
+            nested = self._local.nested = list()
+
+        wall, cpu = default_timer(), time.thread_time()
+        nested.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            nested_wall, nested_cpu = nested.pop()
+            wall = default_timer() - wall
+            cpu = time.thread_time() - cpu
+            rss = max_rss()
+            if nested:
+                nested[-1][0] += wall
+                nested[-1][1] += cpu
+
+            with self._lock:
+                stats = self._stats(name)
+                stats['wall'] += wall - nested_wall
+                stats['cpu'] += cpu - nested_cpu
+                stats['rows'] += rows
+                if rss is not None:
+                    stats['max_rss'] = max(stats['max_rss'] or 0, rss)
+
+    def merge(self, metrics):
+        """Adds the metrics of another run, such as a partition run by a
+        worker process, to these metrics.
+
+        Phase times are added up, so the phases of runs in parallel can take
+        longer than the run itself.
+
+        Args:
+            metrics (dict): The `as_dict` of the other run.
+
+        """
+        with self._lock:
+            for name, other in metrics['phases'].items():
+                stats = self._stats(name)
+                for key in ('wall', 'cpu', 'rows'):
+                    stats[key] += other[key]
+                if other['max_rss'] is not None:
+                    stats['max_rss'] = max(stats['max_rss'] or 0,
+                                           other['max_rss'])
+            self.inserted += metrics['inserted']
+            self.expired += metrics['expired']
+            self.unchanged += metrics['unchanged']
+            self.cache_bytes = max(self.cache_bytes, metrics['cache_bytes'])
+
+    def add_rows(self, name, rows):
+        """Adds `rows` to the rows processed by phase `name`.
+        """
+        with self._lock:
+            self._stats(name)['rows'] += rows
+
+    def sample_cache(self, cache):
+        """Records the memory used by `cache` if it is the peak so far.
+        """
+        self.cache_bytes = max(self.cache_bytes, cache.nbytes)
+
+    def as_dict(self):
+        """Returns the metrics as a JSON serializable dict.
+        """
+        phases = OrderedDict()
+        for name, stats in self.phases.items():
+            phases[name] = dict(stats, rows_per_sec=(
+                stats['rows'] / stats['wall'] if stats['wall'] else None))
+
+        return OrderedDict([
+            ('wall', default_timer() - self._start),
+            ('cpu', time.process_time() - self._cpu_start),
+            ('phases', phases),
+            ('inserted', self.inserted),
+            ('expired', self.expired),
+            ('unchanged', self.unchanged),
+            ('cache_bytes', self.cache_bytes),
+            ('max_rss', max_rss()),
+        ])
+
+    def __str__(self):
+        phases = ', '.join('{} {:.3f}s'.format(name, stats['wall'])
+                           for name, stats in self.phases.items())
+        return ('{} inserted, {} expired, {} unchanged; {}'
+                .format(self.inserted, self.expired, self.unchanged,
+                        phases or 'no phases'))
 
 
 class TemporalTable(sqla.CopyToTable):
     """A class for accessing a temporal table.
 
-    Args:
-        delete (Optional[boolean]): If True, rows in the DB not present in the
-            input will be set as obsolete. Defaults to True.
+    Args:
+        delete (Optional[boolean]): If True, rows in the DB not present in the
+            input will be set as obsolete. Defaults to True.
+
+    Usage:
+        Subclass and override the required attributes:
+            `connection_string`
+            `table`
+            `columns`
+            `natural_key`
+            `asof`
+
+        Optional:
+            obsolete_deleted_rows: If True, rows in the DB not present in the
+                input will be set as obsolete. Defaults to True.
+            set_based: If True, the input is staged into a temporary table
+                and new, changed and deleted rows are detected with set-based
+                SQL instead of being compared in Python. Natural keys can't
+                be NULL. Defaults to False.
+            row_hash: If True, new tables get a `RowHash` column holding the
+                hash of each version, so stored rows are never rehashed.
+                Defaults to False.
+            compact_cache: If True, current versions are cached in a
+                `CompactKeyCache` instead of a dict based `KeyCache`, which
+                uses a fraction of the memory. Defaults to False.
+            memory_budget: Memory, in bytes, the cache may use. If the
+                estimated size of the cache for the current versions is
+                larger, a disk-backed `DiskKeyCache` is used instead.
+                Defaults to None, no limit.
+            hash_algorithm: Algorithm used to detect changed rows. Either a
+                backend of `HASH_BACKENDS` ('blake2b', 'builtin', and
+                'xxh64'/'xxh128' when xxhash is installed) or a `hashlib`
+                algorithm, hashed row by row, or 'pandas', a 128-bit hash
+                computed on whole chunks with `pandas.util.hash_pandas_object`
+                from arrays typed by the column types.
+                Changing it on a table with a `RowHash` column versions every
+                row once. Defaults to 'blake2b'.
+            row_encoding: How rows are serialized for the row by row hash
+                algorithms. 'canonical' encodes each value from the type of
+                its column, tagged and length-prefixed, with fixed-width
+                numbers and dates, so that different rows never serialize
+                alike and a value hashes the same whatever its Python type.
+                'legacy' joins the `str()` of the values, as earlier
+                versions did. Changing it on a table with a `RowHash`
+                column versions every row once. Defaults to 'canonical'.
+            stage_obsolete_ids: If True, ids to set as obsolete are copied
+                into a temporary table and expired with a single
+                `UPDATE ... WHERE id IN (SELECT ...)` instead of `chunksize`
+                batches of single row updates. Defaults to False.
+            bulk_load: If True, rows are inserted with the bulk loader of
+                `BULK_LOADERS` matching the output engine dialect, if any:
+                `fast_executemany` with pyodbc and `COPY FROM STDIN` with
+                psycopg2. Defaults to True.
+            partitions: Number of hash partitions of the natural key space.
+                If greater than 1, each partition is diffed by a separate
+                worker process into staging tables, and the staged changes
+                are applied to the table in a single final transaction.
+                A single integer key column, in the table and the input, is
+                partitioned in SQL by its value modulo `partitions`, with
+                NULL keys in partition 0. Other keys are partitioned by
+                `key_hash` in Python, so every worker reads the whole input
+                and all current versions: the partitions only split the
+                hashing, lookups and writes, for `partitions` times the
+                reads. Ignored in set-based mode. Defaults to 1.
+            watermark_column: Name of a column, such as a last modified
+                timestamp, that grows whenever a source row changes. If set,
+                only source rows at or above the watermark, the greatest
+                value of the column already loaded in the table, are read,
+                only the current versions of their keys are cached, and
+                deleted rows are not detected. Defaults to None.
+            full_scan: If True, incremental tasks read the whole input, so
+                deleted rows are detected. Defaults to False.
+            columnar: If True, the input is read as DataFrames of `chunksize`
+                rows, see `frames`, which are stamped, and hashed with the
+                'pandas' `hash_algorithm`, as a whole. Natural keys are still
+                looked up one by one in the cache and new versions are
+                inserted as rows by the bulk loaders. Defaults to False.
+            merge_diff: If True, the current versions and the input are both
+                read sorted by natural key and diffed with a streaming merge
+                join, so memory use doesn't depend on the table size. The
+                database must sort the keys as Python compares them, e.g.
+                numbers or binary collated strings, and keys can't be NULL.
+                Defaults to False.
+            history_index: If True, the table gets a composite index on
+                `natural_key + [SysStartDate, SysEndDate]`, used by `as_of`
+                and `history`. It replaces the natural key index on new
+                tables and is added to existing ones. Defaults to True.
+            bootstrap: If True, a table without any row version, e.g. on
+                the first load, is filled with a straight bulk load of the
+                input: the cache isn't filled, nothing is compared, and the
+                indexes on the natural key and `SysEndDate` are built after
+                the load. Defaults to True.
+            defer_indexes_above: Number of input rows above which the
+                indexes on the natural key and `SysEndDate` are dropped once
+                the current versions are cached, and rebuilt after the
+                changes are written. Other indexes of the table are always
+                maintained. Not used with `merge_diff` or `set_based`, which
+                read the table while writing it. Defaults to None, indexes
+                are always maintained.
+            commit_every: Number of input chunks after which the changes
+                are committed, together with a checkpoint that lets a rerun
+                of the task resume after the last committed chunk. The input
+                is read sorted by natural key, which can't be NULL and must
+                be unique, one group of chunks at a time, so no input cursor
+                is open when the changes are committed. Deleted rows are
+                expired in the last transaction. Ignored with
+                `set_based`, `merge_diff` or `partitions`. Defaults to None,
+                a run is a single transaction.
+            checkpoint_table: Table where the checkpoints of `commit_every`
+                are kept. Defaults to 'table_checkpoints'.
+            pipeline: If True, the cached diff runs as a pipeline: a thread
+                reads the next input chunks and another compares them to the
+                cache while the changes of the previous chunks are written.
+                Writes stay on the connection of the run, so it is still a
+                single transaction. Not used with `columnar` or
+                `commit_every`. Defaults to False.
+            pipeline_depth: Number of chunks queued between the stages of
+                the pipeline. Defaults to 2.
+            max_delete_fraction: Largest fraction of the current versions
+                that may be missing from the input, e.g. 0.1. If more are,
+                the run raises RuntimeError before they are set as obsolete
+                and the transaction is rolled back, so a partial input can't
+                expire the table. Partitions are checked one by one.
+                Defaults to None, no limit.
+
+    """
+    enddate = datetime.datetime.strptime('2999-12-31', '%Y-%m-%d').date()
+    obsolete_deleted_rows = True
+    chunksize = 5000
+    set_based = False
+    row_hash = False
+    compact_cache = False
+    memory_budget = None
+    hash_algorithm = 'blake2b'
+    row_encoding = 'canonical'
+    stage_obsolete_ids = False
+    bulk_load = True
+    partitions = 1
+    watermark_column = None
+    full_scan = False
+    columnar = False
+    merge_diff = False
+    history_index = True
+    bootstrap = True
+    defer_indexes_above = None
+    commit_every = None
+    checkpoint_table = 'table_checkpoints'
+    pipeline = False
+    pipeline_depth = 2
+    max_delete_fraction = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Current version of each natural key, see `_prefill_cache`
+        self.cache = None
+
+        # (column, encoder) pairs of the rows hashed so far, by their tuple
+        # of column names, see `_encode_row`
+        self.row_encoders = dict()
+
+        # Partition processed by this instance, the tables where its
+        # changes are staged and whether the partition is filtered in SQL,
+        # see `_run_partition`
+        self.partition = None
+        self.partition_stage = None
+        self.partition_by_modulo = False
+
+        # Greatest value of `watermark_column` loaded before this run
+        self.watermark = None
+
+        # Names of the input columns, in the order of the tuples yielded by
+        # `rows(as_tuples=True)`
+        self.source_columns = None
+
+        # True while the input is bulk loaded by `_run_bootstrap`
+        self.bootstrapping = False
+
+        # Time and row counts of the phases of the run, and the input
+        # table reflected by the run, see `_start_run`
+        self.metrics = RunMetrics()
+        self.input_table = None
+
+        # Natural key of the last input row committed by a previous attempt
+        # of the run, and of the last input row read, after which the next
+        # group of chunks is read, see `_run_checkpointed`
+        self.resume_key = None
+        self.last_key = None
+
+        # List of ids not seen in the input. This need to stay outside of the
+        # rows loop because we need to read all chunks to be sure that an id
+        # is not present in any of them.
+        self.obsolete_ids = list()
+
+    def _make_cache(self, conn, keys=None):
+        """Returns an empty cache of the current versions.
+
+        The cache is spilled to disk if its estimated size, from the number
+        of current versions or of the `keys` to cache, exceeds
+        `memory_budget`.
+
+        """
+        cache_class = CompactKeyCache if self.compact_cache else KeyCache
+
+        if self.memory_budget is not None:
+            if keys is None:
+                count = self._count_current(conn)
+            else:
+                count = len(keys)
+            estimate = count * cache_class.bytes_per_key
+            if estimate > self.memory_budget:
+                self._logger.debug('Estimated cache size of {} bytes for {} '
+                                   'keys exceeds the memory budget, using a '
+                                   'disk cache'.format(estimate, count))
+                return DiskKeyCache()
+
+        return cache_class()
+
+    def _hash(self, row, algorithm=None, encoding='latin-1'):
+        """Computes the hex digest of the entire row.
+           See hashlib.algorithms_guaranteed for the complete algorithm list.
+        """
+        return self._digest(row, algorithm, encoding).hex()
+
+    def _digest(self, row, algorithm=None, encoding='latin-1'):
+        """Computes hash of the entire row as raw bytes.
+        """
+        algorithm = algorithm or self.hash_algorithm
+        if algorithm in FRAME_HASH_ALGORITHMS:
+            return self._digest_rows([row])[0]
+
+        if self.row_encoding == 'legacy':
+            values = [row[col] for col in sorted(row.keys())
+                      if col not in SYSTEM_COLUMNS]
+            data = b''.join(value if isinstance(value, bytes)
+                            else str(value).encode(encoding)
+                            for value in values)
+        else:
+            data = self._encode_row(row)
+
+        backend = HASH_BACKENDS.get(algorithm)
+        if backend is None:
+            return hashlib.new(algorithm, data).digest()
+        return backend(data)
+
+    def _column_types(self):
+        """Returns the SQLAlchemy type of each column, from `columns` or,
+        for the columns it doesn't type, the table.
+        """
+        types = dict()
+        if getattr(self, 'table_bound', None) is not None:
+            types.update((c.key, c.type) for c in self.table_bound.columns)
+        for column in self.columns:
+            if len(column) == 2 and len(column[0]) == 2:
+                name, type_ = column[0]
+                types[name] = type_() if isinstance(type_, type) else type_
+        return types
+
+    def _encode_row(self, row):
+        """Serializes the values of a row with the canonical encoding.
+
+        Columns are taken in name order, system columns excluded, and each
+        value is encoded by the `column_encoder` of its column type. Values
+        that don't fit their type are encoded as text.
+
+        """
+        names = tuple(row)
+        encoders = self.row_encoders.get(names)
+        if encoders is None:
+            types = self._column_types()
+            encoders = self.row_encoders[names] = [
+                (name, column_encoder(types.get(name)))
+                for name in sorted(names) if name not in SYSTEM_COLUMNS]
+
+        fields = list()
+        for name, encode in encoders:
+            value = row[name]
+            if value is None:
+                fields.append(_NULL_FIELD)
+                continue
+            try:
+                fields.append(encode(value))
+            except _ENCODING_ERRORS:
+                fields.append(_encode_text(value))
+        return b''.join(fields)
+
+    def _digest_rows(self, rows):
+        """Computes the digest of each row of a chunk.
+
+        Frame algorithms hash the whole chunk at once, other algorithms fall
+        back to `_digest` row by row.
+
+        """
+        if not rows:
+            return list()
+        if self.hash_algorithm not in FRAME_HASH_ALGORITHMS:
+            with self.metrics.phase('hash', len(rows)):
+                return [self._digest(row) for row in rows]
+
+        # Column order is computed once per chunk
+        columns = sorted(c for c in rows[0] if c not in SYSTEM_COLUMNS)
+        frame = pd.DataFrame(
+            dict((c, [row[c] for row in rows]) for c in columns),
+            columns=columns, dtype=object)
+        return self._digest_frame(frame)
+
+    def _digest_frame(self, frame):
+        """Computes a 128-bit digest of each row of a DataFrame.
+
+        Each column is converted to the arrays of `_frame_column`, so that
+        values hash the same whatever the chunk they are in. The digest is
+        made of two 64-bit hashes of those arrays, combined from the
+        `pandas.util.hash_array` of each array with different keys.
+
+        """
+        with self.metrics.phase('hash', len(frame)):
+            types = self._column_types()
+            arrays = list()
+            for name in frame.columns:
+                arrays.extend(_frame_column(
+                    frame[name].to_numpy(dtype=object), types.get(name)))
+            hashes = list()
+            for hash_key in ('0123456789123456', 'TemporalTable128'):
+                combined = np.zeros(len(frame), dtype='<u8')
+                for values in arrays:
+                    combined *= _HASH_MULTIPLIER
+                    combined ^= _hash_array(values, hash_key)
+                hashes.append(combined)
+            buffer = np.column_stack(hashes).tobytes()
+            return [buffer[i:i + 16] for i in range(0, len(buffer), 16)]
+
+    @property
+    def _has_row_hash(self):
+        """True if the target table stores the hash of each row version.
+        """
+        return 'RowHash' in self.table_bound.columns
+
+    def _make_search_tuple(self, row):
+        return tuple(row[key] for key in self.natural_key)
+
+    @property
+    def _incremental(self):
+        """True if only the input rows above the watermark are read.
+        """
+        return (self.watermark_column is not None and
+                self.watermark is not None and not self.full_scan)
+
+    @property
+    def _detect_deletes(self):
+        """True if rows missing from the input are set as obsolete.
+        """
+        return self.obsolete_deleted_rows and not self._incremental
+
+    def _read_watermark(self, conn):
+        """Reads the greatest value of `watermark_column` in the table.
+
+        The watermark is derived from the loaded rows themselves, so it is
+        always committed together with them.
+
+        """
+        if self.watermark_column is None:
+            return None
+        if self.watermark_column not in self.table_bound.columns:
+            raise ValueError('Watermark column {!r} is not a column of {}'
+                             .format(self.watermark_column, self.table))
+
+        column = self.table_bound.c[self.watermark_column]
+        self.watermark = conn.execute(
+            sqlalchemy.select([sqlalchemy.func.max(column)])).scalar()
+        self._logger.debug('Watermark of {}: {!r}'
+                           .format(self.table, self.watermark))
+        return self.watermark
+
+    def _can_partition_by_modulo(self):
+        """True if partitions can be taken modulo a single key column that
+        is an integer in both the table and the input, which the database
+        can filter. Other keys are partitioned by `key_hash` in Python.
+        """
+        if len(self.natural_key) != 1:
+            return False
+        key = self.natural_key[0]
+        with self.input().engine.connect() as conn:
+            source = self._input_table(conn)
+        return all(isinstance(table.c[key].type, Integer)
+                   for table in (self.table_bound, source))
+
+    def _partition_clause(self, table):
+        """SQL filter on `table` selecting the rows of `self.partition`.
+
+        NULL keys belong to partition 0.
+
+        Returns:
+            The filter clause, or None if there is no partition or it can only
+            be filtered in Python with `_in_partition`.
+
+        """
+        if self.partition is None or not self.partition_by_modulo:
+            return None
+        column = table.c[self.natural_key[0]]
+        clause = (sqlalchemy.func.abs(column) % self.partitions ==
+                  self.partition)
+        if self.partition == 0:
+            clause = sqlalchemy.or_(column.is_(None), clause)
+        return clause
+
+    def _in_partition(self, searchtuple):
+        """True if the natural key belongs to `self.partition`.
+        """
+        if self.partition is None or self.partition_by_modulo:
+            return True
+        return key_hash(searchtuple) % self.partitions == self.partition
+
+    def _current_versions(self, conn, ordered=False, keys=None):
+        """Yields (natural key, id, digest) of the rows currently valid.
+
+        Only current versions are read, through a server-side cursor, and
+        only the columns needed to get their digests are selected.
+
+        Args:
+            conn (sqlalchemy.engine): The sqlalchemy connection object.
+            ordered (Optional[bool]): If True, rows are sorted by natural key.
+                Defaults to False.
+            keys (Optional[list]): Natural key tuples. If given, only the
+                current versions of these keys are read. Defaults to None,
+                every key.
+
+        """
+        table = self.table_bound
+        if self._has_row_hash:
+            # Stored hashes are used as is, so only the key, id and hash
+            # columns need to be read.
+            columns = [table.c[c]
+                       for c in self.natural_key + ['id', 'RowHash']]
+        else:
+            columns = [c for c in table.columns
+                       if c.key not in ('SysStartDate', 'SysEndDate')]
+
+        sql = (sqlalchemy.select(columns).
+               where(table.c.SysEndDate == self.enddate))
+        if self._partition_clause(table) is not None:
+            sql = sql.where(self._partition_clause(table))
+        if keys is not None:
+            sql = sql.where(self._keys_clause(table, keys))
+        if ordered:
+            sql = sql.order_by(*[table.c[key] for key in self.natural_key])
+        result = conn.execution_options(stream_results=True).execute(sql)
+        keys = result.keys()
+
+        for chunk in iter(lambda: result.fetchmany(self.chunksize), []):
+            row_dicts = [dict(zip(keys, row)) for row in chunk]
+
+            if self._has_row_hash:
+                digests = [bytes.fromhex(row_dict['RowHash'])
+                           for row_dict in row_dicts]
+            else:
+                digests = self._digest_rows(row_dicts)
+
+            for row_dict, digest in zip(row_dicts, digests):
+                searchtuple = self._make_search_tuple(row_dict)
+                if self._in_partition(searchtuple):
+                    yield searchtuple, row_dict['id'], digest
+
+    def _keys_clause(self, table, keys):
+        """SQL filter on `table` selecting the natural key tuples `keys`.
+
+        NULL keys are matched with `IS NULL`.
+
+        """
+        if len(self.natural_key) == 1:
+            column = table.c[self.natural_key[0]]
+            values = [key[0] for key in keys if key[0] is not None]
+            clause = column.in_(values)
+            if len(values) < len(keys):
+                clause = sqlalchemy.or_(clause, column.is_(None))
+            return clause
+
+        # Comparisons to None are rendered as IS NULL
+        return sqlalchemy.or_(*[
+            sqlalchemy.and_(*[table.c[column] == value
+                              for column, value in zip(self.natural_key,
+                                                       key)])
+            for key in keys])
+
+    def _count_current(self, conn):
+        """Returns the number of current versions in the partition of the
+        run, estimated if the partitions are only known to Python.
+        """
+        table = self.table_bound
+        sql = (sqlalchemy.select([sqlalchemy.func.count()]).
+               where(table.c.SysEndDate == self.enddate))
+        clause = self._partition_clause(table)
+        if clause is not None:
+            sql = sql.where(clause)
+        count = conn.execute(sql).scalar()
+        if self.partition is not None and clause is None:
+            count //= self.partitions
+        return count
+
+    def _check_deletes(self, deleted, current):
+        """Raises RuntimeError if `deleted` of the `current` versions is
+        more than `max_delete_fraction` of them.
+        """
+        if self.max_delete_fraction is None or not deleted:
+            return
+        if deleted > self.max_delete_fraction * current:
+            raise RuntimeError(
+                '{} of the {} current versions of {} are missing from the '
+                'input, more than the max_delete_fraction of {:g}; deleted '
+                'rows were not set as obsolete'
+                .format(deleted, current, self.table,
+                        self.max_delete_fraction))
+
+    def _check_staged_deletes(self, conn, stage, current=None):
+        """Applies `max_delete_fraction` to the versions missing from the
+        input staged in `stage`.
+
+        Args:
+            conn (sqlalchemy.engine): The sqlalchemy connection object.
+            stage (sqlalchemy.Table): The staged input.
+            current (Optional): Clause selecting the current versions.
+                Defaults to None, every row of the table.
+
+        """
+        if not self._detect_deletes or self.max_delete_fraction is None:
+            return
+
+        target = self.table_bound
+        sql = sqlalchemy.select([sqlalchemy.func.count()]).select_from(target)
+        if current is not None:
+            sql = sql.where(current)
+        matched = sqlalchemy.exists().where(self._key_clause(target, stage))
+        self._check_deletes(conn.execute(sql.where(~matched)).scalar(),
+                            conn.execute(sql).scalar())
+
+    def _prefill_cache(self, conn):
+        """Cache hash and id of rows that are currently valid.
+
+        Incremental runs only cache the current versions of the keys of the
+        input rows, see `_input_keys`.
+
+        If a cache that only stores key hashes finds two keys with the same
+        hash, the current versions are cached again in a `KeyCache`.
+
+        """
+        self._logger.debug('Loading temporal table hash cache')
+
+        with self.metrics.phase('prefill'):
+            keys = self._input_keys() if self._incremental else None
+            self.cache = self._make_cache(conn, keys)
+            try:
+                self._fill_cache(conn, keys)
+            except KeyHashCollision as e:
+                self._logger.warning('{}, caching the current versions of {} '
+                                     'by natural key'.format(e, self.table))
+                self.cache.close()
+                self.cache = KeyCache()
+                self._fill_cache(conn, keys)
+        self.metrics.add_rows('prefill', len(self.cache))
+        self.metrics.sample_cache(self.cache)
+        self._logger.debug('{} current versions cached'
+                           .format(len(self.cache)))
+
+    def _fill_cache(self, conn, keys=None):
+        """Adds the current versions, of the natural keys `keys` if given,
+        to the empty `self.cache`.
+
+        Keys are looked up in batches that fit the 999 parameters SQLite
+        accepts per statement.
+
+        """
+        if keys is None:
+            versions = self._current_versions(conn)
+        else:
+            size = max(1, 999 // len(self.natural_key))
+            versions = itertools.chain.from_iterable(
+                self._current_versions(conn, keys=keys[i:i + size])
+                for i in range(0, len(keys), size))
+
+        for searchtuple, id, digest in versions:
+            self.cache.add(searchtuple, id, digest)
+        self.cache.freeze()
+
+    def _input_keys(self):
+        """Returns the distinct natural keys of the input rows of the run.
+        """
+        keys = set()
+        with self.input().engine.connect() as conn:
+            source = self._input_table(conn)
+            sql = sqlalchemy.select([source.c[key]
+                                     for key in self.natural_key])
+            for clause in self._source_filters(source):
+                sql = sql.where(clause)
+            result = conn.execution_options(stream_results=True).execute(sql)
+            for chunk in iter(lambda: result.fetchmany(self.chunksize), []):
+                keys.update(tuple(row) for row in chunk)
+
+        self._logger.debug('{} input keys to look up'.format(len(keys)))
+        return list(keys)
+
+    def _set_as_obsolete(self, conn, ids, table_bound):
+        """This method set rows as obsolete updating the `SysEndDate` column of
+        rows given by ids to `asof`.
+
+        The updates are sent in `chunksize` batches, or staged and applied
+        with one statement if `stage_obsolete_ids`.
+
+        Args:
+            conn (sqlalchemy.engine): The sqlalchemy connection object.
+            ids (iterable): Ids to set as obsolete.
+            table_bound (sqlalchemy.Table): The object referring to the table
+
+        Returns:
+            int: Number of ids set as obsolete.
+
+        """
+        if self.stage_obsolete_ids:
+            return self._set_as_obsolete_staged(conn, ids, table_bound)
+
+        sql = (table_bound.update().\
+            where(table_bound.c.id == sqlalchemy.bindparam('_id')).\
+            values(SysEndDate=sqlalchemy.bindparam('_SysEndDate')))
+
+        ids = iter(ids)
+        count = 0
+        for chunk in iter(lambda: list(itertools.islice(ids, self.chunksize)),
+                          []):
+            rows = [{'_id': id, '_SysEndDate': self.asof} for id in chunk]
+            conn.execute(sql, rows)
+            count += len(rows)
+
+        self._logger.debug('{} rows set as obsolete'.format(count))
+        return count
+
+    def _set_as_obsolete_staged(self, conn, ids, table_bound):
+        """Set rows as obsolete with one `UPDATE` joined to a staged id table.
+        """
+        stage = self._create_stage_table(
+            conn, 'obsolete_' + table_bound.name,
+            [sqlalchemy.Column('id', Integer, primary_key=True)])
+
+        ids = iter(ids)
+        for chunk in iter(lambda: list(itertools.islice(ids, self.chunksize)),
+                          []):
+            conn.execute(stage.insert(), [{'id': id} for id in chunk])
+
+        sql = (table_bound.update().
+               where(table_bound.c.id.in_(sqlalchemy.select([stage.c.id]))).
+               values(SysEndDate=self.asof))
+        count = conn.execute(sql).rowcount
+        stage.drop(conn)
+
+        self._logger.debug('{} rows set as obsolete'.format(count))
+        return count
+
+    def create_table(self, engine):
+        """Override of the `luigi.contrib.sqla.create_table()` with only one
+        modification: it inserts some special rows when creating tables.
+
+        """
+        def construct_sqla_columns(columns):
+            # A copy, `columns` may be shared by every instance of the class
+            columns = list(columns)
+            columns.insert(0, (['id', Integer], {'primary_key': True}))
+            columns.append((['SysStartDate', Date], {}))
+            columns.append((['SysEndDate', Date], {'index': True}))
+            if self.row_hash:
+                columns.append((['RowHash', VARCHAR(128)], {}))
+
+            retval = [sqlalchemy.Column(*c[0], **c[1]) for c in columns]
+            return retval
+
+        needs_setup = (len(self.columns) == 0) or (False in [len(c) == 2 for c in self.columns]) if not self.reflect else False
+        if needs_setup:
+            # only names of columns specified, no types
+            raise NotImplementedError("create_table() not implemented for %r "
+                                      "and columns types not "
+                                      "specified" % self.table)
+        else:
+            # if columns is specified as (name, type) tuples
+            with engine.begin() as con:
+                metadata = sqlalchemy.MetaData()
+                try:
+                    if not con.dialect.has_table(con, self.table):
+                        sqla_columns = construct_sqla_columns(self.columns)
+                        self.table_bound = sqlalchemy.Table(self.table,
+                                                            metadata,
+                                                            *sqla_columns)
+
+                        # Create index on natural keys, which is a prefix
+                        # of the history index
+                        if self.history_index:
+                            self._history_index()
+                        else:
+                            index_name =\
+                                'ix_{}_{}'.format(self.table_bound.name,
+                                                  '_'.join(self.natural_key))
+                            index_columns = [getattr(self.table_bound.c, c)
+                                             for c in self.natural_key]
+                            Index(index_name, *index_columns)
+
+                        # Create table
+                        self.table_bound.create(engine, checkfirst=True)
+
+                        # Search for TEXT columns
+                        bound_cols = \
+                            dict((c, sqlalchemy.bindparam('_' + c.key))
+                                 for c in self.table_bound.columns
+                                 if isinstance(c.type, sqlalchemy.TEXT))
+                        sql = self.table_bound.insert().values(bound_cols)
+
+                        # Fill TEXT columns with a predefined value
+                        ins_rows = \
+                            dict(zip(['_' + c.key for c in bound_cols],
+                                     ['#Não informado'] * len(bound_cols)))
+
+                        con.execute(sql, ins_rows)
+                    else:
+                        self.table_bound = reflected_table(engine,
+                                                           self.table)
+                        if self.history_index:
+                            self._ensure_history_index(con)
+                except Exception as e:
+                    self._logger.exception(self.table + str(e))
+
+    def _history_columns(self):
+        return [self.table_bound.c[c]
+                for c in self.natural_key + ['SysStartDate', 'SysEndDate']]
+
+    def _history_index(self):
+        """Returns the composite index used by point-in-time queries.
+        """
+        return Index('ix_{}_history'.format(self.table_bound.name),
+                     *self._history_columns())
+
+    def _ensure_history_index(self, conn):
+        """Creates the history index on an existing table if it has no index
+        on the same columns.
+        """
+        columns = [c.key for c in self._history_columns()]
+        for index in self.table_bound.indexes:
+            if [c.key for c in index.columns] == columns:
+                return
+
+        self._logger.info('Creating history index on {}'.format(self.table))
+        self._history_index().create(conn)
+
+    def _table(self, engine):
+        """Returns the bound table, reflecting it if needed.
+        """
+        if getattr(self, 'table_bound', None) is None:
+            self.table_bound = reflected_table(engine, self.table)
+        return self.table_bound
+
+    def _read_frames(self, sql, chunksize=None):
+        """Reads the result of `sql` on the output engine into DataFrames.
+
+        The result is always fetched in chunks from a server-side cursor.
+
+        Args:
+            sql: The query.
+            chunksize (Optional[int]): If given, an iterator of DataFrames of
+                `chunksize` rows is returned instead of a single DataFrame.
+
+        """
+        frames = self._iter_frames(sql, chunksize or self.chunksize)
+        if chunksize is not None:
+            return frames
+        return pd.concat(list(frames), ignore_index=True)
+
+    def _iter_frames(self, sql, chunksize):
+        with self.output().engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(sql)
+            keys = list(result.keys())
+
+            # The first frame is yielded even if empty, to carry the columns
+            chunk = result.fetchmany(chunksize)
+            yield pd.DataFrame.from_records(chunk, columns=keys)
+            for chunk in iter(lambda: result.fetchmany(chunksize), []):
+                yield pd.DataFrame.from_records(chunk, columns=keys)
+
+    def as_of(self, date, chunksize=None):
+        """Returns the rows that were valid at `date`.
+
+        Args:
+            date (datetime.date): Point in time of the snapshot.
+            chunksize (Optional[int]): If given, an iterator of DataFrames of
+                `chunksize` rows is returned instead of a single DataFrame.
+
+        Returns:
+            pandas.DataFrame: The table as it was at `date`.
+
+        """
+        table = self._table(self.output().engine)
+        sql = sqlalchemy.select([table]).where(sqlalchemy.and_(
+            table.c.SysStartDate <= date, table.c.SysEndDate > date))
+        return self._read_frames(sql, chunksize)
+
+    def history(self, key, chunksize=None):
+        """Returns every version of a natural key, oldest first.
+
+        Args:
+            key: Value of the natural key, or a tuple of values if the natural
+                key has more than one column.
+            chunksize (Optional[int]): If given, an iterator of DataFrames of
+                `chunksize` rows is returned instead of a single DataFrame.
+
+        Returns:
+            pandas.DataFrame: The versions of `key`.
+
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        table = self._table(self.output().engine)
+        sql = (sqlalchemy.select([table]).
+               where(sqlalchemy.and_(*[table.c[column] == value
+                                       for column, value
+                                       in zip(self.natural_key, key)])).
+               order_by(table.c.SysStartDate))
+        return self._read_frames(sql, chunksize)
+
+    def _source_filters(self, table_bound):
+        """Returns the clauses selecting the input rows of this run, by
+        partition and watermark.
+
+        Rows at the watermark are read again, since rows with the same
+        watermark value may have arrived after the last run. Those that were
+        loaded are unchanged.
+
+        """
+        filters = list()
+        if self._partition_clause(table_bound) is not None:
+            filters.append(self._partition_clause(table_bound))
+        if self._incremental:
+            filters.append(
+                table_bound.c[self.watermark_column] >= self.watermark)
+        return filters
+
+    def _after_key_clause(self, table, key):
+        """SQL filter on `table` selecting the natural keys sorted after
+        `key`.
+        """
+        columns = [table.c[c] for c in self.natural_key]
+        clause = None
+        for column, value in reversed(list(zip(columns, key))):
+            if clause is None:
+                clause = column > value
+            else:
+                clause = sqlalchemy.or_(
+                    column > value, sqlalchemy.and_(column == value, clause))
+        return clause
+
+    def _source_query(self, table_bound, after_key=None, limit=None):
+        """Returns the query that selects the input rows from `table_bound`.
+
+        Args:
+            table_bound (sqlalchemy.Table): The input table.
+            after_key (Optional[tuple]): If given, only the rows whose
+                natural key sorts after it are selected.
+            limit (Optional[int]): Greatest number of rows selected.
+
+        """
+        sql = sqlalchemy.select([table_bound])
+        for clause in self._source_filters(table_bound):
+            sql = sql.where(clause)
+        if after_key is not None:
+            sql = sql.where(self._after_key_clause(table_bound, after_key))
+        if self.merge_diff or self._checkpointed:
+            sql = sql.order_by(*[table_bound.c[key]
+                                 for key in self.natural_key])
+        if limit is not None:
+            sql = sql.limit(limit)
+        return sql
+
+    def _input_table(self, conn):
+        """Returns the input table, reflected on `conn` once per run.
+
+        The input isn't cached by `reflected_table`, as the upstream task
+        may rebuild it with other columns between two runs in the process.
+
+        """
+        if self.input_table is None:
+            self.input_table = sqlalchemy.Table(
+                self.input().target_table, sqlalchemy.MetaData(),
+                autoload=True, autoload_with=conn)
+        return self.input_table
+
+    def _start_run(self):
+        """Resets the state of a previous run of the instance, which luigi
+        reuses when the task is run again.
+        """
+        self.metrics = RunMetrics()
+        self.input_table = None
+
+    def rows(self, skiprows=1, as_tuples=False, after_key=None, limit=None):
+        """Return/yield tuples or lists corresponding to each input row.
+
+        This is an override of the `luigi.contrib.sqla.CopyToTable.rows()`
+        that uses SQLAlchemyTarget instead of LocalTarget inputs.
+
+        Rows are streamed from a server-side cursor in `chunksize` batches.
+
+        Args:
+            as_tuples (Optional[bool]): If True, yields tuples ordered as
+                `self.source_columns` instead of dicts. Defaults to False.
+            after_key (Optional[tuple]): If given, only the rows whose
+                natural key sorts after it are read, see `_source_query`.
+            limit (Optional[int]): Greatest number of rows read.
+
+        """
+        def convert(keys, chunk):
+            if as_tuples:
+                return [tuple(row) for row in chunk]
+            return [dict(zip(keys, row)) for row in chunk]
+
+        for chunk in self._fetch_chunks(convert, after_key, limit):
+            for row in chunk:
+                yield row
+
+    def frames(self, after_key=None, limit=None):
+        """Yields the input rows as DataFrames of `chunksize` rows.
+
+        Each frame is built from the columns of a batch fetched from the
+        cursor. Values are kept as Python objects, the same values `rows`
+        yields.
+
+        Args:
+            after_key (Optional[tuple]): See `rows`.
+            limit (Optional[int]): See `rows`.
+
+        """
+        def convert(keys, chunk):
+            return pd.DataFrame(dict(zip(keys, zip(*chunk))),
+                                columns=keys, dtype=object)
+
+        return self._fetch_chunks(convert, after_key, limit)
+
+    def _fetch_chunks(self, convert, after_key=None, limit=None):
+        """Yields the input rows in batches of `chunksize` rows fetched
+        from a server-side cursor.
+
+        Args:
+            convert (function): Called with the column names and the rows
+                of each batch, returns the batch yielded.
+            after_key (Optional[tuple]): See `rows`.
+            limit (Optional[int]): See `rows`.
+
+        """
+        try:
+            engine = self.input().engine
+        except AttributeError:
+            raise TypeError('Input must be an SQLAlchemyTarget')
+
+        with engine.connect() as conn:
+            table_bound = self._input_table(conn)
+            sql = self._source_query(table_bound, after_key, limit)
+            result = conn.execution_options(stream_results=True).execute(sql)
+            keys = self.source_columns = list(result.keys())
+
+            while True:
+                with self.metrics.phase('read'):
+                    chunk = result.fetchmany(self.chunksize)
+                    if not chunk:
+                        break
+                    chunk = convert(keys, chunk)
+                self.metrics.add_rows('read', len(chunk))
+                yield chunk
+
+    def run(self):
+        """Lookup and insert/update a version of a temporal table row.
+        """
+        self._start_run()
+        self._logger.info('Updating temporal table {}: {}'
+                          .format(self.table, self.update_id()))
+        output = self.output()
+        engine = output.engine
+        self.create_table(engine)
+
+        if (self._has_row_hash
+                and self.hash_algorithm in UNSTABLE_HASH_ALGORITHMS):
+            raise ValueError('{!r} digests can not be stored in the RowHash '
+                             'column'.format(self.hash_algorithm))
+
+        if self.partitions > 1 and not self.set_based:
+            self._run_partitioned(engine)
+        elif self._checkpointed:
+            self._run_checkpointed(engine)
+        else:
+            with engine.begin() as conn:
+                if self.set_based:
+                    self._run_set_based(conn)
+                else:
+                    self._run_diff(conn)
+
+        output.touch()
+        self._logger.info("Finished inserting rows into SQLAlchemy target")
+        self._report_metrics()
+
+    def _report_metrics(self):
+        """Logs the metrics of the run, with the dict of
+        `RunMetrics.as_dict` in the `ttable_metrics` attribute of the log
+        record, and sets them as the status message of the luigi task.
+        """
+        metrics = self.metrics.as_dict()
+        self._logger.info('Metrics of {}: {}'.format(self.table,
+                                                      self.metrics),
+                          extra={'ttable_metrics': metrics})
+
+        # Only set when the task is run by a luigi worker
+        if callable(self.set_status_message):
+            self.set_status_message(json.dumps(metrics))
+
+    def _run_diff(self, conn):
+        """Detect and log changes diffing the input in Python.
+        """
+        if self.bootstrap and self._is_empty(conn):
+            self._run_bootstrap(conn)
+        elif self.merge_diff:
+            self._run_merge(conn)
+        else:
+            self._run_cached(conn)
+
+    def _is_empty(self, conn):
+        """True if the table has no row versions, such as a table just
+        created.
+
+        The placeholder row inserted by `create_table` is not a version, it
+        has no `SysStartDate`. A table whose versions were all set as
+        obsolete is not empty.
+
+        """
+        table = self.table_bound
+        sql = (sqlalchemy.select([table.c.id]).
+               where(table.c.SysStartDate.isnot(None)).limit(1))
+        return conn.execute(sql).first() is None
+
+    def _run_bootstrap(self, conn):
+        """Bulk loads every input row into an empty table.
+
+        All input rows are new, so they are inserted as they are read, and
+        only hashed if the table stores their hash. The indexes created by
+        `create_table` are dropped before the load and rebuilt after it, and
+        on SQL Server the inserts take a table lock so they can be minimally
+        logged.
+
+        """
+        self._logger.info('{} is empty, bulk loading the input'
+                          .format(self.table))
+        with self._deferred_indexes(conn):
+            self._load_all(conn)
+
+    def _load_all(self, conn):
+        """Inserts every input row as a new version.
+        """
+        self._read_watermark(conn)
+
+        count = 0
+        self.bootstrapping = True
+        try:
+            rows = self.rows()
+            for chunk in iter(
+                    lambda: list(itertools.islice(rows, self.chunksize)), []):
+                chunk = [row for row in chunk
+                         if self._in_partition(self._make_search_tuple(row))]
+                if not chunk:
+                    continue
+                for row in chunk:
+                    row['SysStartDate'] = self.asof
+                    row['SysEndDate'] = self.enddate
+                self._write_versions(conn, chunk)
+                count += len(chunk)
+        finally:
+            self.bootstrapping = False
+
+        self._logger.debug('{} rows bulk loaded'.format(count))
+
+    def _owned_indexes(self):
+        """Returns the indexes `create_table` puts on the table: on the
+        natural key or the history columns, and on `SysEndDate`.
+
+        Other indexes, e.g. created by a DBA, may be clustered, filtered or
+        have included columns that reflection doesn't return, so they could
+        not be rebuilt as they were.
+
+        """
+        name = self.table_bound.name
+        owned = {
+            'ix_{}_history'.format(name):
+                [c.key for c in self._history_columns()],
+            'ix_{}_{}'.format(name, '_'.join(self.natural_key)):
+                list(self.natural_key),
+            'ix_{}_SysEndDate'.format(name): ['SysEndDate'],
+        }
+        return [index for index in self.table_bound.indexes
+                if not index.unique and
+                owned.get(index.name) == [c.key for c in index.columns]]
+
+    def _drop_indexes(self, conn):
+        """Drops the indexes of the table created by `create_table`, see
+        `_owned_indexes`.
+
+        Returns:
+            list: The dropped `sqlalchemy.Index` objects, see
+                `_create_indexes`.
+
+        """
+        indexes = self._owned_indexes()
+        for index in indexes:
+            self._logger.debug('Dropping index {}'.format(index.name))
+            index.drop(conn)
+        return indexes
+
+    def _create_indexes(self, conn, indexes):
+        """Creates the indexes dropped by `_drop_indexes`.
+        """
+        for index in indexes:
+            self._logger.debug('Creating index {}'.format(index.name))
+            index.create(conn)
+
+    @contextlib.contextmanager
+    def _deferred_indexes(self, conn, defer=True):
+        """Context manager that drops the indexes created by `create_table`
+        on entry and rebuilds them on exit, logging how long each step took.
+
+        Indexes are left alone when running a partition, whose changes are
+        written to staging tables, or if `defer` is False. If the block
+        raises, the indexes are not rebuilt: the transaction is rolled back.
+
+        """
+        if not defer or self.partition_stage is not None:
+            yield
+            return
+
+        with Timer() as t, self.metrics.phase('indexes'):
+            indexes = self._drop_indexes(conn)
+        self._logger.info('Dropped {} indexes of {} in {} seconds'
+                          .format(len(indexes), self.table, t.elapsed))
+
+        yield
+
+        with Timer() as t, self.metrics.phase('indexes'):
+            self._create_indexes(conn, indexes)
+        self._logger.info('Rebuilt {} indexes of {} in {} seconds'
+                          .format(len(indexes), self.table, t.elapsed))
+
+    def _count_input(self):
+        """Returns the number of input rows the run will read.
+        """
+        engine = self.input().engine
+        with engine.connect() as conn:
+            table_bound = self._input_table(conn)
+            sql = self._source_query(table_bound).order_by(None).alias()
+            return conn.execute(sqlalchemy.select(
+                [sqlalchemy.func.count()]).select_from(sql)).scalar()
+
+    def _count_null_keys(self):
+        """Returns the number of input rows the run will read that have a
+        NULL natural key column.
+        """
+        engine = self.input().engine
+        with engine.connect() as conn:
+            table_bound = self._input_table(conn)
+            sql = self._source_query(table_bound).order_by(None).alias()
+            return conn.execute(
+                sqlalchemy.select([sqlalchemy.func.count()]).select_from(sql).
+                where(sqlalchemy.or_(*[sql.c[key].is_(None)
+                                       for key in self.natural_key]))
+            ).scalar()
+
+    def _defer_indexes(self):
+        """True if the input is large enough to load without indexes, see
+        `defer_indexes_above`.
+        """
+        if (self.defer_indexes_above is None
+                or self.partition_stage is not None):
+            return False
+        count = self._count_input()
+        self._logger.debug('{} input rows'.format(count))
+        return count > self.defer_indexes_above
+
+    def _run_merge(self, conn):
+        """Detect and log changes with a sort-merge join of the input and the
+        current versions.
+
+        The current versions are read on a separate connection, so that the
+        changes written on `conn` don't show up in the snapshot being read.
+
+        """
+        self._logger.debug('Logging changes with a merge join')
+        self._read_watermark(conn)
+
+        # NULL keys can't be sorted as Python compares them
+        nulls = self._count_null_keys()
+        if nulls:
+            raise ValueError('{} input rows of {} have a NULL natural key, '
+                             'which merge_diff does not support'
+                             .format(nulls, self.table))
+
+        with self.output().engine.connect() as snapshot_conn:
+            current = self._ordered(
+                self._current_versions(snapshot_conn, ordered=True),
+                lambda version: version[0], 'current versions')
+            rows = self._ordered(self.rows(), self._make_search_tuple,
+                                 'input rows')
+            count = None
+            if self.max_delete_fraction is not None:
+                count = self._count_current(conn)
+            self._log_changes_merge(rows, current, conn, count)
+
+        if self.obsolete_ids:
+            self._expire(conn, self.obsolete_ids)
+
+    def _ordered(self, iterable, key, name):
+        """Yields the items of `iterable`, checking they are sorted by `key`
+        and that no key has a NULL column.
+        """
+        previous = None
+        for item in iterable:
+            current = key(item)
+            if None in current:
+                raise ValueError('The {} of {} have a NULL natural key: {!r}'
+                                 .format(name, self.table, current))
+            if previous is not None and current < previous:
+                raise ValueError('The {} of {} are not sorted by natural key '
+                                 'as Python compares them: {!r} after {!r}'
+                                 .format(name, self.table, current, previous))
+            previous = current
+            yield item
+
+    def _log_changes_merge(self, rows, current, conn, count=None):
+        """Diffs sorted input rows against sorted current versions.
+
+        Args:
+            rows (iterable): Input rows sorted by natural key.
+            current (iterable): (natural key, id, digest) of the current
+                versions sorted by natural key.
+            conn (sqlalchemy.engine): The sqlalchemy connection object.
+            count (Optional[int]): Number of current versions, needed to
+                apply `max_delete_fraction` as deleted rows are found.
+
+        """
+        new_rows = list()
+        modified_rows = list()
+        deleted = 0
+
+        version = next(current, None)
+        rows = iter(rows)
+        for chunk in iter(lambda: list(itertools.islice(rows, self.chunksize)),
+                          []):
+            chunk = [row for row in chunk
+                     if self._in_partition(self._make_search_tuple(row))]
+            for row, digest in zip(chunk, self._digest_rows(chunk)):
+                row['SysStartDate'] = self.asof
+                row['SysEndDate'] = self.enddate
+                searchtuple = self._make_search_tuple(row)
+
+                # Current versions before this key are missing from the input
+                while version is not None and version[0] < searchtuple:
+                    if self._detect_deletes:
+                        self.obsolete_ids.append(version[1])
+                        deleted += 1
+                        self._check_deletes(deleted, count)
+                    version = next(current, None)
+
+                if version is None or version[0] != searchtuple:
+                    # It is a new member. We add the first version.
+                    new_rows.append(row)
+                    continue
+
+                if self._has_row_hash:
+                    row['RowHash'] = digest.hex()
+                if version[2] != digest:
+                    modified_rows.append(row)
+                    self.obsolete_ids.append(version[1])
+                else:
+                    self.metrics.unchanged += 1
+                version = next(current, None)
+
+            if new_rows:
+                self._logger.debug('Writing {} rows'.format(len(new_rows)))
+                self._write_versions(conn, new_rows)
+                new_rows = list()
+
+            if modified_rows:
+                self._logger.debug('Updating {} rows'
+                                   .format(len(modified_rows)))
+                self._write_versions(conn, modified_rows)
+                modified_rows = list()
+
+            if (len(self.obsolete_ids) >= self.chunksize
+                    and not self.stage_obsolete_ids):
+                self._expire(conn, self.obsolete_ids)
+                self.obsolete_ids = list()
+
+        # Current versions after the last input key
+        while version is not None:
+            if self._detect_deletes:
+                self.obsolete_ids.append(version[1])
+                deleted += 1
+                self._check_deletes(deleted, count)
+            version = next(current, None)
+
+        self._logger.debug('{} rows deleted from the input'.format(deleted))
+
+    def _run_cached(self, conn):
+        """Detect and log changes comparing input rows to the hash cache.
+        """
+        self._read_watermark(conn)
+        self._prefill_cache(conn)
+        try:
+            with self._deferred_indexes(conn, self._defer_indexes()):
+                if self.columnar:
+                    self._log_changes_frames(self.frames(), conn)
+                elif self.pipeline:
+                    self._log_changes_pipelined(self.rows(), conn)
+                else:
+                    rows = self.rows()
+                    self._log_changes(rows, conn)
+
+                # Check if there were deleted rows.
+                # We can only check if there were deleted rows after going
+                # through all input rows.
+                if self._detect_deletes:
+                    deleted_ids = self.cache.unseen_ids()
+                    self._logger.debug('{} rows deleted from the input'
+                                       .format(len(deleted_ids)))
+                    self._check_deletes(len(deleted_ids), len(self.cache))
+                    self.obsolete_ids.extend(deleted_ids)
+
+                # Update the `SysEndDate` attribute in the old row version
+                # and in the deleted rows in the DB.
+                if self.obsolete_ids:
+                    self._expire(conn, self.obsolete_ids)
+        finally:
+            self.metrics.sample_cache(self.cache)
+            self.cache.close()
+
+    @property
+    def _checkpointed(self):
+        """True if the changes are committed every `commit_every` chunks.
+        """
+        return (self.commit_every is not None and
+                not (self.set_based or self.merge_diff))
+
+    def _checkpoint_table(self):
+        """Returns the table where the checkpoints of the runs are kept.
+        """
+        metadata = sqlalchemy.MetaData()
+        return sqlalchemy.Table(
+            self.checkpoint_table, metadata,
+            sqlalchemy.Column('update_id', VARCHAR(128), primary_key=True),
+            sqlalchemy.Column('target_table', VARCHAR(128)),
+            sqlalchemy.Column('commits', Integer),
+            sqlalchemy.Column('last_key', TEXT),
+            sqlalchemy.Column('watermark', TEXT),
+            sqlalchemy.Column('updated', sqlalchemy.DateTime))
+
+    def _write_checkpoint(self, conn, checkpoint, commits):
+        """Records that the input rows up to `last_key` are written.
+        """
+        update_id = self.update_id()
+        conn.execute(checkpoint.delete().
+                     where(checkpoint.c.update_id == update_id))
+        conn.execute(checkpoint.insert().values(
+            update_id=update_id, target_table=self.table, commits=commits,
+            last_key=_dump_json(self.last_key),
+            watermark=_dump_json(self.watermark),
+            updated=datetime.datetime.now()))
+
+    def _track_keys(self, chunks):
+        """Yields the input rows or frames, keeping the natural key of the
+        last one in `last_key`.
+        """
+        for chunk in chunks:
+            if isinstance(chunk, pd.DataFrame):
+                self.last_key = tuple(chunk[key].iloc[-1]
+                                      for key in self.natural_key)
+            else:
+                self.last_key = self._make_search_tuple(chunk)
+            yield chunk
+
+    def _visit_done_keys(self):
+        """Marks the input keys up to `resume_key`, written by a previous
+        attempt of the run, as seen in the cache.
+        """
+        engine = self.input().engine
+        count = 0
+        with engine.connect() as conn:
+            table_bound = self._input_table(conn)
+            sql = sqlalchemy.select([table_bound.c[key]
+                                     for key in self.natural_key])
+            for clause in self._source_filters(table_bound):
+                sql = sql.where(clause)
+            sql = sql.where(~self._after_key_clause(table_bound,
+                                                    self.resume_key))
+            result = conn.execution_options(stream_results=True).execute(sql)
+            for chunk in iter(lambda: result.fetchmany(self.chunksize), []):
+                self.cache.visit_many([tuple(row) for row in chunk])
+                count += len(chunk)
+
+        self._logger.debug('{} input keys were already loaded'.format(count))
+
+    def _run_checkpointed(self, engine):
+        """Detect and log changes comparing input rows to the hash cache,
+        committing every `commit_every` chunks.
+
+        Each commit records the natural key of the last input row written in
+        the checkpoint table. A rerun of the task resumes after that key: the
+        keys up to it are only marked as seen. Rows missing from the input
+        are expired in the last transaction, which also clears the
+        checkpoint, so a rerun after it finds nothing left to do.
+
+        """
+        checkpoint = self._checkpoint_table()
+        update_id = self.update_id()
+        # Ids left over by a failed attempt of the run were rolled back
+        self.obsolete_ids = list()
+
+        with engine.connect() as conn:
+            trans = conn.begin()
+            try:
+                checkpoint.create(conn, checkfirst=True)
+                state = conn.execute(checkpoint.select().where(
+                    checkpoint.c.update_id == update_id)).first()
+                if state is None:
+                    commits = 0
+                    self.resume_key = self.last_key = None
+                    self._read_watermark(conn)
+                else:
+                    commits = state.commits
+                    self.resume_key = self.last_key = tuple(
+                        _load_json(state.last_key))
+                    self.watermark = _load_json(state.watermark)
+                    self._logger.info('Resuming {} after checkpoint {} at '
+                                      'key {!r}'.format(self.table, commits,
+                                                        self.resume_key))
+
+                self._prefill_cache(conn)
+                try:
+                    if self.resume_key is not None:
+                        self._visit_done_keys()
+
+                    # Each group is read into memory with its own query, so
+                    # no input cursor is left open across the commits
+                    size = self.commit_every * self.chunksize
+                    while True:
+                        if self.columnar:
+                            group = list(self._track_keys(
+                                self.frames(self.last_key, size)))
+                            count = sum(len(frame) for frame in group)
+                        else:
+                            group = list(self._track_keys(
+                                self.rows(after_key=self.last_key,
+                                          limit=size)))
+                            count = len(group)
+                        if not count:
+                            break
+
+                        if self.columnar:
+                            self._log_changes_frames(group, conn)
+                        else:
+                            self._log_changes(group, conn)
+
+                        if self.obsolete_ids:
+                            self._expire(conn, self.obsolete_ids)
+                            self.obsolete_ids = list()
+
+                        commits += 1
+                        self._write_checkpoint(conn, checkpoint, commits)
+                        trans.commit()
+                        trans = conn.begin()
+                        self._logger.debug('Checkpoint {} of {} at key {!r}'
+                                           .format(commits, self.table,
+                                                   self.last_key))
+                        if count < size:
+                            break
+
+                    if self._detect_deletes:
+                        deleted_ids = self.cache.unseen_ids()
+                        self._logger.debug('{} rows deleted from the input'
+                                           .format(len(deleted_ids)))
+                        self._check_deletes(len(deleted_ids),
+                                            len(self.cache))
+                        self.obsolete_ids.extend(deleted_ids)
+                        if self.obsolete_ids:
+                            self._expire(conn, self.obsolete_ids)
+                finally:
+                    self.metrics.sample_cache(self.cache)
+                    self.cache.close()
+
+                conn.execute(checkpoint.delete().where(
+                    checkpoint.c.update_id == update_id))
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
 
-    Usage:
-        Subclass and override the required attributes:
-            `connection_string`
-            `table`
-            `columns`
-            `natural_key`
-            `asof`
+    def _partition_stage_tables(self, partition):
+        """Returns the tables where the changes of a partition are staged.
 
-        Optional:
-            obsolete_deleted_rows: If True, rows in the DB not present in the
-                input will be set as obsolete. Defaults to True.
+        Returns:
+            tuple: (versions, ids) tables. `versions` holds the new row
+                versions and `ids` the ids of the versions to set as obsolete.
 
-    """
-    enddate = datetime.datetime.strptime('2999-12-31', '%Y-%m-%d').date()
-    obsolete_deleted_rows = True
-    chunksize = 5000
-    
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        """
+        metadata = sqlalchemy.MetaData()
+        name = '{}_part{}'.format(self.table_bound.name, partition)
+        versions = sqlalchemy.Table(
+            name + '_versions', metadata,
+            *[sqlalchemy.Column(c.name, c.type)
+              for c in self.table_bound.columns if c.key != 'id'])
+        ids = sqlalchemy.Table(
+            name + '_ids', metadata,
+            sqlalchemy.Column('id', Integer, primary_key=True))
+        return versions, ids
 
-        self.keycache = dict()
-        self.idcache = dict()
-        self.seenkeys = dict()
+    def _run_partition(self, partition):
+        """Diffs one partition, staging its changes instead of applying them.
 
-        # List of ids not seen in the input. This need to stay outside of the
-        # rows loop because we need to read all chunks to be sure that an id
-        # is not present in any of them.
-        self.obsolete_ids = list()
+        Returns:
+            dict: The `RunMetrics.as_dict` of the partition.
 
-    def _hash(self, row, algorithm='sha256', encoding='latin-1'):
-        """Computes hash of the entire row.
-           See hashlib.algorithms_guaranteed for the complete algorithm list.
         """
-        m = hashlib.new(algorithm)
+        self._start_run()
+        self.partition = partition
+        engine = self.output().engine
+        self.create_table(engine)
+        self.partition_by_modulo = self._can_partition_by_modulo()
+        self.partition_stage = self._partition_stage_tables(partition)
+        self._logger.debug('Processing partition {} of {}'
+                           .format(partition, self.partitions))
 
-        values = [row[col] for col in sorted(row.keys())
-                  if col not in ['id', 'SysStartDate', 'SysEndDate']]
-        for value in values:
-            if not isinstance(value, bytes):
-                value = str(value).encode(encoding)
-            m.update(value)
+        with engine.begin() as conn:
+            for stage in self.partition_stage:
+                stage.drop(conn, checkfirst=True)
+                stage.create(conn)
+            self._run_diff(conn)
+        self._report_metrics()
+        return self.metrics.as_dict()
 
-        return m.hexdigest()
-    
-    def _make_search_tuple(self, row):
-        return tuple(row[key] for key in self.natural_key)
+    def _run_partitioned(self, engine):
+        """Diffs each partition in a worker process, then applies the staged
+        changes of all partitions in a single transaction.
+
+        The metrics of the workers are merged into `metrics`, and the time
+        spent applying their changes is the 'apply' phase.
 
-    def _prefill_cache(self, conn):
-        """Cache hash and id of rows that are currently valid.
         """
-        self._logger.debug('Loading temporal table hash cache')
+        partitions = range(self.partitions)
+        stages = [self._partition_stage_tables(p) for p in partitions]
+        args = [(type(self), self.param_kwargs, p) for p in partitions]
+        if not self._can_partition_by_modulo():
+            self._logger.warning('Partitions of {} are filtered in Python, '
+                                 'each of the {} workers reads the whole '
+                                 'input'.format(self.table, self.partitions))
 
-        with self.output().engine.begin() as conn:
-                engine = self.output().engine
-                session = Session(engine)
+        try:
+            # Forked workers must not share the connections of the pools
+            engine.dispose()
+            self.input().engine.dispose()
+            pool = multiprocessing.Pool(self.partitions)
+            try:
+                for metrics in pool.map(_partition_worker, args):
+                    self.metrics.merge(metrics)
+            finally:
+                pool.close()
+                pool.join()
 
-                for row in session.query(
-                    self.table_bound).yield_per(self.chunksize):
-                    row_dict = dict(zip(self.table_bound.columns.keys(), row))
-                    searchtuple = self._make_search_tuple(row_dict)
+            target = self.table_bound
+            defer = self._defer_indexes()
+            with engine.begin() as conn, \
+                    self._deferred_indexes(conn, defer):
+                for versions, ids in stages:
+                    # The workers counted the rows they staged
+                    with self.metrics.phase('apply'):
+                        sql = (target.update().
+                               where(target.c.id.in_(
+                                   sqlalchemy.select([ids.c.id]))).
+                               values(SysEndDate=self.asof))
+                        expired = conn.execute(sql).rowcount
 
-                    self.keycache[searchtuple] = self._hash(row_dict)
-                    self.idcache[searchtuple] = row_dict['id']
+                        columns = [c.key for c in versions.columns]
+                        inserted = conn.execute(target.insert().from_select(
+                            columns, sqlalchemy.select(
+                                [versions.c[c] for c in columns]))).rowcount
+                    self.metrics.add_rows('apply', expired + inserted)
 
-    def _set_as_obsolete(self, conn, ids, table_bound):
-        """This method set rows as obsolete updating the `SysEndDate` column of
-        rows given by ids to `asof`.
+                    self._logger.debug('{} rows set as obsolete and {} rows '
+                                       'inserted from {}'
+                                       .format(expired, inserted,
+                                               versions.name))
+        finally:
+            with engine.begin() as conn:
+                for stage in itertools.chain(*stages):
+                    stage.drop(conn, checkfirst=True)
 
-        Args:
-            conn (sqlalchemy.engine): The sqlalchemy connection object.
-            ids (list): List of ids to set as obsolete.
-            table_bound (sqlalchemy.Table): The object referring to the table
+    def _write_versions(self, conn, rows):
+        """Inserts new row versions, or stages them when running a partition.
+        """
+        with self.metrics.phase('insert', len(rows)):
+            if self.partition_stage is not None:
+                self._insert(conn, rows, self.partition_stage[0])
+            else:
+                self._insert(conn, rows, self.table_bound)
+        self.metrics.inserted += len(rows)
 
+    def _expire(self, conn, ids):
+        """Sets rows as obsolete, or stages their ids when running a
+        partition.
         """
-        rows = [{'_id': id, '_SysEndDate': self.asof} for id in ids]
+        with self.metrics.phase('expire'):
+            if self.partition_stage is None:
+                count = self._set_as_obsolete(conn, ids, self.table_bound)
+            else:
+                count = self._stage_obsolete_ids(conn, ids)
+        self.metrics.expired += count
+        self.metrics.add_rows('expire', count)
+        return count
 
-        sql = (self.table_bound.update().\
-            where(self.table_bound.c.id == sqlalchemy.bindparam('_id')).\
-            values(SysEndDate=sqlalchemy.bindparam('_SysEndDate')))
+    def _stage_obsolete_ids(self, conn, ids):
+        """Copies the ids to set as obsolete to the partition staging table.
+        """
+        stage = self.partition_stage[1]
+        ids = iter(ids)
+        count = 0
+        for chunk in iter(lambda: list(itertools.islice(ids, self.chunksize)),
+                          []):
+            self._load(conn, [{'id': id} for id in chunk], stage, [stage.c.id])
+            count += len(chunk)
+        return count
 
-        conn.execute(sql, rows)
+    def _create_stage_table(self, conn, name, columns):
+        """Creates a temporary table used to stage data on the server.
 
+        Args:
+            conn (sqlalchemy.engine): The sqlalchemy connection object.
+            name (str): Name of the staging table.
+            columns (list): List of `sqlalchemy.Column` objects.
 
-    def create_table(self, engine):
-        """Override of the `luigi.contrib.sqla.create_table()` with only one
-        modification: it inserts some special rows when creating tables.
+        Returns:
+            sqlalchemy.Table: The staging table.
 
         """
-        def construct_sqla_columns(columns):
-            columns.insert(0, (['id', Integer], {'primary_key': True}))
-            columns.append((['SysStartDate', Date], {}))
-            columns.append((['SysEndDate', Date], {'index': True}))
+        metadata = sqlalchemy.MetaData()
+        if conn.dialect.name == 'mssql':
+            # SQL Server temporary tables are identified by the name prefix
+            stage = sqlalchemy.Table('#' + name, metadata, *columns)
+        else:
+            stage = sqlalchemy.Table(name, metadata, *columns,
+                                     prefixes=['TEMPORARY'])
+        stage.create(conn)
+        return stage
 
-            retval = [sqlalchemy.Column(*c[0], **c[1]) for c in columns]
-            return retval
+    def _stage_rows(self, conn, rows, stage):
+        """Copies input rows into the staging table in `chunksize` batches.
+        """
+        keys = stage.columns.keys()
+        rows = iter(rows)
+        count = 0
+        while True:
+            chunk = [dict((key, row.get(key)) for key in keys)
+                     for row in itertools.islice(rows, self.chunksize)]
+            if not chunk:
+                break
+            if 'RowHash' in stage.columns:
+                for row, digest in zip(chunk, self._digest_rows(chunk)):
+                    row['RowHash'] = digest.hex()
+            self._load(conn, chunk, stage, list(stage.columns))
+            count += len(chunk)
+        self._logger.debug('{} rows staged'.format(count))
+        return count
 
-        needs_setup = (len(self.columns) == 0) or (False in [len(c) == 2 for c in self.columns]) if not self.reflect else False
-        if needs_setup:
-            # only names of columns specified, no types
-            raise NotImplementedError("create_table() not implemented for %r "
-                                      "and columns types not "
-                                      "specified" % self.table)
-        else:
-            # if columns is specified as (name, type) tuples
-            with engine.begin() as con:
-                metadata = sqlalchemy.MetaData()
-                try:
-                    if not con.dialect.has_table(con, self.table):
-                        sqla_columns = construct_sqla_columns(self.columns)
-                        self.table_bound = sqlalchemy.Table(self.table,
-                                                            metadata,
-                                                            *sqla_columns)
+    def _index_stage(self, conn, stage):
+        """Indexes the staged input on the natural key, so the set-based
+        statements look each key up instead of scanning the stage, and
+        raises ValueError if a staged natural key is NULL.
 
-                        # Create index on natural keys
-                        index_name =\
-                            'ix_{}_{}'.format(self.table_bound.name,
-                                              '_'.join(self.natural_key))
-                        index_columns = [getattr(self.table_bound.c, c)
-                                         for c in self.natural_key]
-                        Index(index_name, *index_columns)
+        Keys are joined with `=`, which never matches NULL, so the
+        versions of a NULL key would be expired and inserted again on every
+        run.
 
-                        # Create table
-                        self.table_bound.create(engine, checkfirst=True)
+        """
+        columns = [stage.c[key] for key in self.natural_key]
+        name = 'ix_{}_key'.format(stage.name.lstrip('#'))
+        Index(name, *columns).create(conn)
 
-                        # Search for TEXT columns
-                        bound_cols = \
-                            dict((c, sqlalchemy.bindparam('_' + c.key))
-                                 for c in self.table_bound.columns
-                                 if isinstance(c.type, sqlalchemy.TEXT))
-                        sql = self.table_bound.insert().values(bound_cols)
+        nulls = conn.execute(
+            sqlalchemy.select([sqlalchemy.func.count()]).select_from(stage).
+            where(sqlalchemy.or_(*[c.is_(None) for c in columns]))).scalar()
+        if nulls:
+            raise ValueError('{} input rows of {} have a NULL natural key, '
+                             'which set-based runs do not support'
+                             .format(nulls, self.table))
 
-                        # Fill TEXT columns with a predefined value
-                        ins_rows = \
-                            dict(zip(['_' + c.key for c in bound_cols],
-                                     ['#Não informado'] * len(bound_cols)))
+    def _key_clause(self, target, stage):
+        """Join condition between `target` and `stage` on the natural key.
+        """
+        return sqlalchemy.and_(*[target.c[key] == stage.c[key]
+                                 for key in self.natural_key])
 
-                        con.execute(sql, ins_rows)
-                    else:
-                        metadata.reflect(bind=engine)
-                        self.table_bound = metadata.tables[self.table]
-                except Exception as e:
-                    self._logger.exception(self.table + str(e))
+    def _changed_clause(self, target, stage):
+        """NULL-safe condition that is true when any attribute differs.
+        """
+        if 'RowHash' in stage.columns:
+            return target.c.RowHash != stage.c.RowHash
 
-    def rows(self, skiprows=1):
-        """Return/yield tuples or lists corresponding to each input row.
+        clauses = list()
+        for column in stage.columns:
+            if column.key in self.natural_key:
+                continue
+            old, new = target.c[column.key], stage.c[column.key]
+            clauses.append(sqlalchemy.or_(
+                old != new,
+                sqlalchemy.and_(old.is_(None), new.isnot(None)),
+                sqlalchemy.and_(old.isnot(None), new.is_(None))))
+        return sqlalchemy.or_(sqlalchemy.false(), *clauses)
 
-        This is an override of the `luigi.contrib.sqla.CopyToTable.rows()`
-        that uses SQLAlchemyTarget instead of LocalTarget inputs.
+    def _run_set_based(self, conn):
+        """Detect and log changes with set-based SQL.
 
-        """
-        try:
-            with self.input().engine.begin() as conn:
-                metadata = sqlalchemy.MetaData()
-                engine = self.input().engine
-                table = self.input().target_table
-                table_bound = sqlalchemy.Table(table,
-                                               metadata,
-                                               autoload=True,
-                                               autoload_with=engine)
-                session = Session(engine)
-                for row in session.query(table_bound).yield_per(self.chunksize):
-                    yield dict(zip(table_bound.columns.keys(), row))
-        except AttributeError:
-            raise TypeError('Input must be an SQLAlchemyTarget')
+        The input is copied into a temporary staging table. Current versions
+        that changed or, if `obsolete_deleted_rows`, that are missing from the
+        input are set as obsolete with one `UPDATE`, then every staged row
+        without a current version is inserted with one `INSERT ... SELECT`.
 
-    def run(self):
-        """Lookup and insert/update a version of a temporal table row.
         """
-        self._logger.info('Updating temporal table {}: {}'
-                          .format(self.table, self.update_id()))
-        output = self.output()
-        engine = output.engine
-        self.create_table(engine)
+        self._logger.debug('Logging changes with set-based SQL')
+        self._read_watermark(conn)
+        target = self.table_bound
+        columns = [sqlalchemy.Column(c.name, c.type) for c in target.columns
+                   if c.key not in SYSTEM_COLUMNS]
+        if self._has_row_hash:
+            columns.append(sqlalchemy.Column('RowHash', VARCHAR(128)))
+        stage = self._create_stage_table(conn, 'stage_' + target.name,
+                                         columns)
+        with self.metrics.phase('stage'):
+            staged = self._stage_rows(conn, self.rows(), stage)
+            self._index_stage(conn, stage)
+        self.metrics.add_rows('stage', staged)
 
-        with engine.begin() as conn:
-            self._prefill_cache(conn)
-            rows = self.rows()
-            self._log_changes(rows, conn)
-
-            # Check if there were deleted rows.
-            # We can only check if there were deleted rows after going
-            # through all input rows.
-            if self.obsolete_deleted_rows:
-                for key, id in self.idcache.items():
-                    if key not in self.seenkeys:
-                        self.obsolete_ids.append(id)
-                self._logger.debug('{} rows set as obsolete'
-                                   .format(len(self.obsolete_ids)))
-
-            # Update the `SysEndDate` attribute in the old row version and
-            # in the deleted rows in the DB.
-            if self.obsolete_ids:
-                self._set_as_obsolete(conn, self.obsolete_ids,
-                                        self.table_bound)
+        current = target.c.SysEndDate == self.enddate
+        self._check_staged_deletes(conn, stage, current)
+        matched = sqlalchemy.exists().where(self._key_clause(target, stage))
+        changed = sqlalchemy.exists().where(sqlalchemy.and_(
+            self._key_clause(target, stage),
+            self._changed_clause(target, stage)))
+        if self._detect_deletes:
+            obsolete = sqlalchemy.or_(changed, ~matched)
+        else:
+            obsolete = changed
 
-        output.touch()
-        self._logger.info("Finished inserting rows into SQLAlchemy target")
+        with self.metrics.phase('expire'):
+            result = conn.execute(target.update().
+                                  where(sqlalchemy.and_(current, obsolete)).
+                                  values(SysEndDate=self.asof))
+        self.metrics.expired += result.rowcount
+        self.metrics.add_rows('expire', result.rowcount)
+        self._logger.debug('{} rows set as obsolete'.format(result.rowcount))
+
+        # Same as `current`, as no date sorts after `enddate`, but without
+        # an equality on `SysEndDate` the key is looked up in the natural
+        # key index instead of scanning the current versions
+        has_current = sqlalchemy.exists().where(sqlalchemy.and_(
+            self._key_clause(target, stage),
+            target.c.SysEndDate >= self.enddate))
+        select = sqlalchemy.select(
+            [stage.c[c.key] for c in columns] +
+            [sqlalchemy.literal(self.asof, Date),
+             sqlalchemy.literal(self.enddate, Date)]).where(~has_current)
+        with self.metrics.phase('insert'):
+            result = conn.execute(target.insert().from_select(
+                [c.key for c in columns] + ['SysStartDate', 'SysEndDate'],
+                select))
+        self.metrics.inserted += result.rowcount
+        self.metrics.add_rows('insert', result.rowcount)
+        self._logger.debug('{} rows inserted'.format(result.rowcount))
+        # Staged rows of new and changed keys are inserted, the others are
+        # unchanged
+        self.metrics.unchanged += staged - result.rowcount
+
+        stage.drop(conn)
 
     def _log_changes(self, rows, conn):
         """Lookup input rows in the db table and keep history of changes
@@ -240,50 +2801,213 @@ class TemporalTable(sqla.CopyToTable):
         new_rows = list()
         modified_rows = list()
         
-        for row in rows:
-            row['SysStartDate'] = self.asof
-            row['SysEndDate'] = self.enddate
-        
-             # Get the newest version and compare to that
-            searchtuple = self._make_search_tuple(row)
-        
-            if searchtuple not in self.idcache:
-                # It is a new member. We add the first version.
-                new_rows.append(row)
-            else:
-                # There is an existing version. Check if the attributes
-                # are identical
-                dim_hash = self.keycache[searchtuple]
-                current_hash = self._hash(row)
-                if dim_hash != current_hash:
-                    # The hash of the rows are different. Add the new version
-                    # of the row to the `modified_rows` list, and the id to the
-                    # `obsolete_ids` list.
-                    modified_rows.append(row)
-                    self.obsolete_ids.append(self.idcache[searchtuple])
-        
-                # Add this key to the `seenkeys` dictionary
-                self.seenkeys[searchtuple] = self.idcache[searchtuple]
+        rows = iter(rows)
+        for chunk in iter(lambda: list(itertools.islice(rows, self.chunksize)),
+                          []):
+            new, modified, obsolete_ids = self._diff_chunk(chunk)
+            new_rows.extend(new)
+            modified_rows.extend(modified)
+            self.obsolete_ids.extend(obsolete_ids)
 
             if len(new_rows) >= self.chunksize:
                 self._logger.debug('Writing {} rows'.format(len(new_rows)))
-                self._insert(conn, new_rows, self.table_bound)
+                self._write_versions(conn, new_rows)
                 new_rows = list()
 
             if len(modified_rows) >= self.chunksize:
                 self._logger.debug('Updating {} rows'.format(len(modified_rows)))
-                self._insert(conn, modified_rows, self.table_bound)
+                self._write_versions(conn, modified_rows)
                 modified_rows = list()
+
+                # Expire the old versions as we go, unless they are staged
+                # to be expired all at once at the end of the run.
+                if not self.stage_obsolete_ids:
+                    self._expire(conn, self.obsolete_ids)
+                    self.obsolete_ids = list()
         
         # Insert new rows
         if new_rows:
             self._logger.debug('Writing {} rows'.format(len(new_rows)))
-            self._insert(conn, new_rows, self.table_bound)
+            self._write_versions(conn, new_rows)
         
         # Insert a new row version of modified rows
         if modified_rows:
             self._logger.debug('Updating {} rows'.format(len(modified_rows)))
-            self._insert(conn, modified_rows, self.table_bound)
+            self._write_versions(conn, modified_rows)
+
+    def _diff_chunk(self, chunk):
+        """Compares a chunk of input rows to the cache.
+
+        Returns:
+            tuple: (new rows, modified rows, obsolete ids), the rows of new
+                members, the new versions of changed rows and the ids of
+                their current versions.
+
+        """
+        new_rows = list()
+        modified_rows = list()
+        obsolete_ids = list()
+
+        existing = list()
+        for row in chunk:
+            row['SysStartDate'] = self.asof
+            row['SysEndDate'] = self.enddate
+
+            # Look the key up, marking it as seen in the input
+            searchtuple = self._make_search_tuple(row)
+            if not self._in_partition(searchtuple):
+                continue
+            cached = self.cache.visit(searchtuple)
+
+            if cached is None:
+                # It is a new member. We add the first version.
+                new_rows.append(row)
+            else:
+                existing.append((row, cached))
+
+        # There is an existing version. Check if the attributes are
+        # identical, hashing the whole chunk at once.
+        digests = self._digest_rows([row for row, cached in existing])
+        for (row, (dim_id, dim_hash)), current_hash in zip(existing,
+                                                           digests):
+            if self._has_row_hash:
+                row['RowHash'] = current_hash.hex()
+            if dim_hash != current_hash:
+                # The hash of the rows are different. Add the new version
+                # of the row to the `modified_rows` list, and the id to the
+                # `obsolete_ids` list.
+                modified_rows.append(row)
+                obsolete_ids.append(dim_id)
+            else:
+                self.metrics.unchanged += 1
+
+        return new_rows, modified_rows, obsolete_ids
+
+    def _log_changes_pipelined(self, rows, conn):
+        """Pipelined version of `_log_changes`.
+
+        A reader thread fetches the input chunks and a diff thread compares
+        them to the cache, while the calling thread writes the changes of the
+        previous chunks on `conn`. The stages are connected by queues of
+        `pipeline_depth` chunks, so a slow stage holds back the others.
+
+        """
+        self._logger.debug('Logging changes with a pipeline')
+
+        chunks = queue.Queue(self.pipeline_depth)
+        changes = queue.Queue(self.pipeline_depth)
+        stop = threading.Event()
+
+        def read():
+            try:
+                for chunk in iter(
+                        lambda: list(itertools.islice(rows, self.chunksize)),
+                        []):
+                    if not _pipe_put(chunks, chunk, stop):
+                        break
+                else:
+                    _pipe_put(chunks, _END, stop)
+            except Exception as e:
+                _pipe_put(chunks, e, stop)
+            finally:
+                rows.close()
+
+        def diff():
+            try:
+                while True:
+                    chunk = _pipe_get(chunks, stop)
+                    if chunk is _END or isinstance(chunk, Exception):
+                        _pipe_put(changes, chunk, stop)
+                        break
+                    if not _pipe_put(changes, self._diff_chunk(chunk), stop):
+                        break
+            except Exception as e:
+                _pipe_put(changes, e, stop)
+
+        threads = [threading.Thread(target=read, name='ttable-read'),
+                   threading.Thread(target=diff, name='ttable-diff')]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = changes.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                new_rows, modified_rows, obsolete_ids = item
+                if new_rows or modified_rows:
+                    self._logger.debug('Writing {} rows ({} new)'.format(
+                        len(new_rows) + len(modified_rows), len(new_rows)))
+                    self._write_versions(conn, new_rows + modified_rows)
+
+                # Expire the old versions as we go, unless they are staged
+                # to be expired all at once at the end of the run.
+                self.obsolete_ids.extend(obsolete_ids)
+                if self.obsolete_ids and not self.stage_obsolete_ids:
+                    self._expire(conn, self.obsolete_ids)
+                    self.obsolete_ids = list()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _log_changes_frames(self, frames, conn):
+        """Columnar version of `_log_changes` that works on DataFrames.
+
+        Each frame is stamped, looked up in the cache, hashed and inserted
+        as a whole.
+
+        """
+        self._logger.debug('Logging changes of frames')
+
+        for frame in frames:
+            keys = list(zip(*[frame[key] for key in self.natural_key]))
+            if self.partition is not None and not self.partition_by_modulo:
+                in_partition = np.array([self._in_partition(key)
+                                         for key in keys], dtype=bool)
+                frame = frame[in_partition]
+                keys = list(itertools.compress(keys, in_partition))
+
+            frame = frame.assign(SysStartDate=self.asof,
+                                 SysEndDate=self.enddate)
+
+            found, dim_ids, dim_hashes = self.cache.visit_many(keys)
+
+            # Stored rows need the digest of every new version, otherwise
+            # only existing members are compared.
+            hashed = frame if self._has_row_hash else frame[found]
+            if self.hash_algorithm in FRAME_HASH_ALGORITHMS:
+                columns = sorted(c for c in hashed.columns
+                                 if c not in SYSTEM_COLUMNS)
+                digests = self._digest_frame(hashed[columns])
+            else:
+                digests = self._digest_rows(hashed.to_dict('records'))
+
+            if self._has_row_hash:
+                frame['RowHash'] = [digest.hex() for digest in digests]
+                digests = list(itertools.compress(digests, found))
+
+            changed = np.array([dim_hash != digest for dim_hash, digest
+                                in zip(dim_hashes, digests)], dtype=bool)
+            insert = ~found
+            insert[found] = changed
+            self.metrics.unchanged += int((~changed).sum())
+
+            if insert.any():
+                self._logger.debug('Writing {} rows ({} new)'
+                                   .format(int(insert.sum()),
+                                           int((~found).sum())))
+                self._write_versions(conn, frame[insert].to_dict('records'))
+
+            if changed.any():
+                self.obsolete_ids.extend(
+                    itertools.compress(dim_ids, changed))
+                if not self.stage_obsolete_ids:
+                    self._expire(conn, self.obsolete_ids)
+                    self.obsolete_ids = list()
 
     def _insert(self, conn, ins_rows, table_bound):
         """This method does the actual insertion of the rows of data given by
@@ -299,7 +3023,365 @@ class TemporalTable(sqla.CopyToTable):
             table_bound (sqlalchemy.Table): The object referring to the table
 
         """
+        if 'RowHash' in table_bound.columns:
+            missing = [row for row in ins_rows if 'RowHash' not in row]
+            for row, digest in zip(missing, self._digest_rows(missing)):
+                row['RowHash'] = digest.hex()
+
+        columns = [c for c in table_bound.columns if c.key != 'id']
+        self._load(conn, ins_rows, table_bound, columns)
+
+    def _load(self, conn, ins_rows, table_bound, columns):
+        """Inserts rows with the bulk loader of the connection dialect.
+
+        Falls back to a plain executemany if `bulk_load` is False or there
+        is no loader for the dialect in `BULK_LOADERS`.
+
+        Args:
+            conn (sqlalchemy.engine): The sqlalchemy connection object.
+            ins_rows (list): Rows to insert, as dicts keyed by column.
+            table_bound (sqlalchemy.Table): The object referring to the table
+            columns (list): Columns of `table_bound` to fill.
+
+        """
+        dialect = conn.dialect
+        loader = BULK_LOADERS.get((dialect.name, dialect.driver))
+        if self.bulk_load and loader is not None:
+            getattr(self, loader)(conn, ins_rows, table_bound, columns)
+            return
+
         bound_cols = dict((c, sqlalchemy.bindparam("_" + c.key))
-                          for c in table_bound.columns if c.key != 'id')
-        sql = table_bound.insert().values(bound_cols)
+                          for c in columns)
+        sql = self._insert_statement(table_bound).values(bound_cols)
         conn.execute(sql, ins_rows)
+
+    def _insert_statement(self, table_bound):
+        """Returns the `INSERT` statement used by the loaders.
+
+        While bootstrapping, inserts into the table take a table lock on
+        SQL Server, which allows minimal logging.
+
+        """
+        sql = table_bound.insert()
+        if self.bootstrapping and table_bound is self.table_bound:
+            sql = sql.with_hint('WITH (TABLOCK)', dialect_name='mssql')
+        return sql
+
+    def _load_fast_executemany(self, conn, ins_rows, table_bound, columns):
+        """Inserts rows with pyodbc `fast_executemany`, which sends all
+        parameters in one round trip.
+        """
+        bound_cols = dict((c, sqlalchemy.bindparam(c.key)) for c in columns)
+        compiled = (self._insert_statement(table_bound).values(bound_cols).
+                    compile(dialect=conn.dialect))
+        params = [tuple(row.get(key) for key in compiled.positiontup)
+                  for row in ins_rows]
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.fast_executemany = True
+            cursor.executemany(str(compiled), params)
+        finally:
+            cursor.close()
+
+    def _load_copy(self, conn, ins_rows, table_bound, columns):
+        """Inserts rows with psycopg2 `COPY ... FROM STDIN`.
+        """
+        buffer = io.StringIO()
+        for row in ins_rows:
+            buffer.write(','.join(_csv_value(row.get(c.key))
+                                  for c in columns))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        preparer = conn.dialect.identifier_preparer
+        sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
+            preparer.format_table(table_bound),
+            ', '.join(preparer.quote(c.name) for c in columns))
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(sql, buffer)
+        finally:
+            cursor.close()
+
+    def _load_multirow(self, conn, ins_rows, table_bound, columns):
+        """Inserts rows with multi-row `INSERT ... VALUES` statements.
+
+        Not used by default, see `BULK_LOADERS`.
+
+        """
+        keys = [c.key for c in columns]
+        # SQLite accepts at most 999 parameters per statement
+        size = max(1, 999 // len(keys))
+        for i in range(0, len(ins_rows), size):
+            values = [dict((key, row.get(key)) for key in keys)
+                      for row in ins_rows[i:i + size]]
+            conn.execute(self._insert_statement(table_bound).values(values))
+
+
+class SystemVersionedTable(TemporalTable):
+    """A temporal table versioned by SQL Server itself.
+
+    On SQL Server 2016 or later the table is created with
+    `SYSTEM_VERSIONING = ON`, so the engine keeps the history of changes in
+    the history table. Each run stages the input into a temporary table and
+    applies it with a single `MERGE`: changed rows are updated, new rows
+    inserted and, if `obsolete_deleted_rows`, missing rows deleted. Versions
+    are stamped by the engine with the transaction time, not `asof`.
+
+    On other dialects, such as SQLite in tests, the table is emulated by
+    `TemporalTable` with set-based change detection, which logs the same
+    changes.
+
+    Usage:
+        Same as `TemporalTable`.
+
+        Optional:
+            history_table: Name of the history table, created in the
+                schema of the table. Defaults to `<table>History`.
+
+    """
+    history_table = None
+    set_based = True
+
+    def _is_native(self, engine):
+        return engine.dialect.name == 'mssql'
+
+    def create_table(self, engine):
+        """Creates the system-versioned table if it doesn't exist.
+        """
+        if not self._is_native(engine):
+            return super().create_table(engine)
+
+        with engine.begin() as con:
+            if not con.dialect.has_table(con, self.table):
+                con.execute(self._create_table_ddl(con.dialect))
+
+            self.table_bound = reflected_table(con, self.table)
+
+    def _create_table_ddl(self, dialect):
+        """Returns the `CREATE TABLE` statements of the table.
+        """
+        preparer = dialect.identifier_preparer
+        columns = [sqlalchemy.Column(*c[0], **c[1]) for c in self.columns
+                   if c[0][0] not in SYSTEM_COLUMNS]
+        if self.row_hash:
+            columns.append(sqlalchemy.Column('RowHash', VARCHAR(128)))
+
+        definitions = ['id INT IDENTITY PRIMARY KEY']
+        definitions += ['{} {}'.format(preparer.quote(c.name),
+                                       c.type.compile(dialect=dialect))
+                        for c in columns]
+        definitions += [
+            'SysStartDate DATETIME2 GENERATED ALWAYS AS ROW START NOT NULL',
+            'SysEndDate DATETIME2 GENERATED ALWAYS AS ROW END NOT NULL',
+            'PERIOD FOR SYSTEM_TIME (SysStartDate, SysEndDate)',
+        ]
+        history = self.history_table or self.table + 'History'
+        # The table is created in the default schema of the connection, and
+        # SQL Server needs the history table schema
+        schema = getattr(dialect, 'default_schema_name', None) or 'dbo'
+
+        return ('CREATE TABLE {table} (\n    {definitions}\n) '
+                'WITH (SYSTEM_VERSIONING = ON '
+                '(HISTORY_TABLE = {schema}.{history}));\n'
+                'CREATE INDEX {index} ON {table} ({keys});'
+                .format(table=preparer.quote(self.table),
+                        definitions=',\n    '.join(definitions),
+                        schema=preparer.quote_schema(schema),
+                        history=preparer.quote(history),
+                        index=preparer.quote('ix_{}_{}'.format(
+                            self.table, '_'.join(self.natural_key))),
+                        keys=', '.join(preparer.quote(key)
+                                       for key in self.natural_key)))
+
+    def _merge_statement(self, dialect, stage):
+        """Returns the `MERGE` that applies the staged rows to the table.
+
+        The `MERGE` outputs the action it took on each row, which `run`
+        counts in the metrics.
+
+        """
+        preparer = dialect.identifier_preparer
+        target = self.table_bound.alias('t')
+        source = stage.alias('s')
+        columns = [preparer.quote(c.name) for c in stage.columns]
+
+        def render(clause):
+            return str(clause.compile(dialect=dialect,
+                                      compile_kwargs={'literal_binds': True}))
+
+        sql = ('MERGE INTO {target} WITH (HOLDLOCK) AS t\n'
+               'USING {stage} AS s ON {on}\n'
+               'WHEN MATCHED AND ({changed}) THEN\n'
+               '    UPDATE SET {update}\n'
+               'WHEN NOT MATCHED BY TARGET THEN\n'
+               '    INSERT ({columns}) VALUES ({values})'
+               .format(target=preparer.format_table(self.table_bound),
+                       stage=preparer.format_table(stage),
+                       on=render(self._key_clause(target, source)),
+                       changed=render(self._changed_clause(target, source)),
+                       update=', '.join('t.{0} = s.{0}'.format(
+                           preparer.quote(c.name)) for c in stage.columns
+                           if c.key not in self.natural_key),
+                       columns=', '.join(columns),
+                       values=', '.join('s.' + c for c in columns)))
+        if self._detect_deletes:
+            sql += '\nWHEN NOT MATCHED BY SOURCE THEN\n    DELETE'
+        return sql + '\nOUTPUT $action;'
+
+    def run(self):
+        """Stage the input and apply it to the table with a `MERGE`.
+        """
+        engine = self.output().engine
+        if not self._is_native(engine):
+            return super().run()
+
+        self._start_run()
+        self._logger.info('Updating system-versioned table {}: {}'
+                          .format(self.table, self.update_id()))
+        output = self.output()
+        self.create_table(engine)
+
+        with engine.begin() as conn:
+            self._read_watermark(conn)
+            columns = [sqlalchemy.Column(c.name, c.type)
+                       for c in self.table_bound.columns
+                       if c.key not in SYSTEM_COLUMNS]
+            if self._has_row_hash:
+                columns.append(sqlalchemy.Column('RowHash', VARCHAR(128)))
+            stage = self._create_stage_table(
+                conn, 'stage_' + self.table_bound.name, columns)
+            with self.metrics.phase('stage'):
+                staged = self._stage_rows(conn, self.rows(), stage)
+                self._index_stage(conn, stage)
+            self.metrics.add_rows('stage', staged)
+
+            # The table only holds current versions
+            self._check_staged_deletes(conn, stage)
+            with self.metrics.phase('merge'):
+                actions = Counter(action for action, in conn.execute(
+                    sqlalchemy.text(
+                        self._merge_statement(conn.dialect, stage))))
+            merged = sum(actions.values())
+            self.metrics.add_rows('merge', merged)
+            # The engine keeps the old version of each updated row
+            self.metrics.inserted += actions['INSERT'] + actions['UPDATE']
+            self.metrics.expired += actions['UPDATE'] + actions['DELETE']
+            self.metrics.unchanged += (staged - actions['INSERT'] -
+                                       actions['UPDATE'])
+            self._logger.debug('{} rows merged'.format(merged))
+            stage.drop(conn)
+
+        output.touch()
+        self._logger.info("Finished inserting rows into SQLAlchemy target")
+        self._report_metrics()
+
+    def as_of(self, date, chunksize=None):
+        """Returns the rows that were valid at `date`, see
+        `TemporalTable.as_of`.
+        """
+        engine = self.output().engine
+        if not self._is_native(engine):
+            return super().as_of(date, chunksize)
+
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime.combine(date, datetime.time())
+        table = self._table(engine)
+        sql = sqlalchemy.text(
+            'SELECT * FROM {} FOR SYSTEM_TIME AS OF :date'
+            .format(engine.dialect.identifier_preparer.format_table(table))
+        ).bindparams(date=date)
+        return self._read_frames(sql, chunksize)
+
+    def history(self, key, chunksize=None):
+        """Returns every version of a natural key, oldest first, see
+        `TemporalTable.history`.
+        """
+        engine = self.output().engine
+        if not self._is_native(engine):
+            return super().history(key, chunksize)
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        preparer = engine.dialect.identifier_preparer
+        table = self._table(engine)
+        where = ' AND '.join('{} = :key{}'.format(preparer.quote(column), i)
+                             for i, column in enumerate(self.natural_key))
+        sql = sqlalchemy.text(
+            'SELECT * FROM {} FOR SYSTEM_TIME ALL WHERE {} '
+            'ORDER BY SysStartDate'.format(preparer.format_table(table), where)
+        ).bindparams(**dict(('key{}'.format(i), value)
+                            for i, value in enumerate(key)))
+        return self._read_frames(sql, chunksize)
+
+
+def run_batch(tasks, workers=None, max_per_target=2):
+    """Runs many `TemporalTable` tasks on one process pool.
+
+    Tasks are started by decreasing luigi `priority`, skipping over those
+    whose target, the database of their `connection_string`, already runs
+    `max_per_target` tasks, so every target is kept busy without being
+    overloaded. Worker processes are reused, and with them the engines
+    cached by `SQLAlchemyTarget` and the target tables cached by
+    `reflected_table`. Complete tasks are skipped.
+
+    Args:
+        tasks (list): The `TemporalTable` tasks, whose class and parameters
+            are sent to the workers.
+        workers (Optional[int]): Number of worker processes. Defaults to the
+            number of CPUs.
+        max_per_target (Optional[int]): Number of tasks run at once on the
+            same target. Defaults to 2.
+
+    Returns:
+        OrderedDict: Result of each task by task id, in completion order:
+            the `RunMetrics.as_dict` of the run, None if the task was
+            already complete, or the exception it raised.
+
+    Raises:
+        ValueError: If `workers` or `max_per_target` is less than 1.
+
+    """
+    if workers is not None and workers < 1:
+        raise ValueError('workers must be at least 1, not {}'
+                         .format(workers))
+    if max_per_target < 1:
+        raise ValueError('max_per_target must be at least 1, not {}'
+                         .format(max_per_target))
+
+    workers = workers or os.cpu_count() or 1
+    pending = sorted(tasks, key=lambda task: -task.priority)
+    running = dict()
+    per_target = Counter()
+    results = OrderedDict()
+
+    with ProcessPoolExecutor(workers) as executor:
+        while pending or running:
+            for task in list(pending):
+                if len(running) >= workers:
+                    break
+                if per_target[task.connection_string] >= max_per_target:
+                    continue
+                pending.remove(task)
+                per_target[task.connection_string] += 1
+                future = executor.submit(_batch_worker,
+                                         (type(task), task.param_kwargs))
+                running[future] = task
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                per_target[task.connection_string] -= 1
+                try:
+                    results[task.task_id] = future.result()
+                except Exception as e:
+                    logger.error('{} failed: {!r}'.format(task.task_id, e))
+                    results[task.task_id] = e
+                else:
+                    logger.info('{} done, {} running, {} pending'
+                                .format(task.task_id, len(running),
+                                        len(pending)))
+
+    return results
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the `ttable` temporal table loader.
+
+Usage:
+    python ttable_bench.py hashes [--rows N] [--width N]
+    python ttable_bench.py load [--rows N] [--width N] [--change-rate R]
+        [--delete-rate R] [--target-url URL] [--option NAME=VALUE ...]
+
+The `hashes` benchmark compares the hash backends available to
+`TemporalTable.hash_algorithm` on synthetic dimension rows.
+
+The `load` benchmark runs a `TemporalTable` end to end: an initial load of
+a synthetic SQLite source, then an incremental load after a share of the
+source rows were changed and deleted. Each load runs in a fresh process and
+its throughput, peak RSS and per-phase `RunMetrics` are reported. The peak
+RSS of a phase is the peak of the process when the phase last ended, so the
+phase where it grows is the one that raised it. The
+target is a temporary SQLite file unless `--target-url` is given, e.g. a
+local PostgreSQL database. Options set `TemporalTable` attributes, e.g.
+`--option set_based=True`.
+
+"""
+
+import argparse
+import ast
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import decimal
+import os
+import random
+import string
+import tempfile
+import warnings
+from timeit import default_timer
+import luigi
+from luigi.contrib import sqla
+import sqlalchemy
+from sqlalchemy import Integer, Numeric, Float, Date, VARCHAR
+import ttable
+
+
+class BenchTable(ttable.TemporalTable):
+    """Temporal table used to drive the benchmarks.
+    """
+    connection_string = 'sqlite://'
+    table = 'bench'
+    natural_key = ['code']
+    asof = luigi.DateParameter(default=datetime.date(2000, 1, 1))
+
+    @property
+    def columns(self):
+        return bench_columns()
+
+
+class BenchSource(luigi.ExternalTask):
+    """Synthetic source table written by `write_source`.
+    """
+    url = luigi.Parameter()
+
+    def output(self):
+        return sqla.SQLAlchemyTarget(self.url, 'bench_source', 'bench_source')
+
+
+class LoadTable(BenchTable):
+    """Temporal table loaded from a `BenchSource` by the `load` benchmark.
+    """
+    connection_string = luigi.Parameter()
+    source_url = luigi.Parameter()
+    width = luigi.IntParameter(default=4)
+
+    @property
+    def columns(self):
+        return bench_columns(self.width)
+
+    def requires(self):
+        return BenchSource(url=self.source_url)
+
+
+def bench_columns(width=4):
+    """Returns the `TemporalTable.columns` of the rows of `make_row`.
+    """
+    columns = [
+        (['code', Integer], {}),
+        (['amount', Numeric(12, 2)], {}),
+        (['ratio', Float], {}),
+        (['created', Date], {}),
+    ]
+    for n in range(width):
+        columns.append((['attr{}'.format(n), VARCHAR(30)], {}))
+    return columns
+
+
+def make_row(i, width=4, rng=random):
+    """Returns a synthetic dimension row.
+
+    Args:
+        i (int): Natural key of the row.
+        width (Optional[int]): Number of text attributes. Defaults to 4.
+        rng (Optional[random.Random]): Random number generator.
+
+    """
+    row = {
+        'code': i,
+        'amount': decimal.Decimal(rng.randrange(10 ** 8)) / 100,
+        'ratio': rng.random(),
+        'created': datetime.date(2000, 1, 1) +
+                   datetime.timedelta(days=rng.randrange(10000)),
+    }
+    for n in range(width):
+        row['attr{}'.format(n)] = ''.join(
+            rng.choice(string.ascii_letters) for _ in range(rng.randrange(30)))
+    return row
+
+
+def make_rows(rows, width=4, change_rate=0.0, delete_rate=0.0, seed=0):
+    """Yields a reproducible snapshot of a synthetic dimension.
+
+    Snapshots made with the same `rows`, `width` and `seed` hold the same
+    rows, except for the shares of rows changed and deleted.
+
+    Args:
+        rows (int): Number of rows before deletes.
+        width (Optional[int]): Number of text attributes. Defaults to 4.
+        change_rate (Optional[float]): Share of the rows changed.
+            Defaults to 0.
+        delete_rate (Optional[float]): Share of the rows left out.
+            Defaults to 0.
+        seed (Optional[int]): Seed of the rows. Defaults to 0.
+
+    """
+    rng = random.Random(seed)
+    changes = random.Random(seed + 1)
+    for i in range(rows):
+        row = make_row(i, width, rng)
+        draw = changes.random()
+        if draw < delete_rate:
+            continue
+        if draw < delete_rate + change_rate:
+            row = make_row(i, width, changes)
+        yield row
+
+
+def write_source(url, rows, width=4, chunksize=10000):
+    """Replaces the `bench_source` table of `url` with `rows`.
+
+    Returns:
+        int: Number of rows written.
+
+    """
+    engine = sqlalchemy.create_engine(url)
+    metadata = sqlalchemy.MetaData()
+    table = sqlalchemy.Table(
+        'bench_source', metadata,
+        *[sqlalchemy.Column(*c[0], **c[1]) for c in bench_columns(width)])
+
+    count = 0
+    with engine.begin() as conn:
+        table.drop(conn, checkfirst=True)
+        table.create(conn)
+        rows = iter(rows)
+        while True:
+            chunk = [row for _, row in zip(range(chunksize), rows)]
+            if not chunk:
+                break
+            conn.execute(table.insert(), chunk)
+            count += len(chunk)
+    engine.dispose()
+    return count
+
+
+def _run_load(args):
+    """Runs one `LoadTable` load in a worker process.
+
+    Returns:
+        dict: `RunMetrics.as_dict` of the load.
+
+    """
+    kwargs, options = args
+    task = LoadTable(**kwargs)
+    for name, value in options.items():
+        setattr(task, name, value)
+    task.run()
+    return task.metrics.as_dict()
+
+
+def benchmark_load(rows, width=4, change_rate=0.1, delete_rate=0.01,
+                   target_url=None, options=None):
+    """Runs an initial and an incremental `TemporalTable` load.
+
+    Args:
+        rows (int): Number of rows of the initial source.
+        width (Optional[int]): Number of text attributes. Defaults to 4.
+        change_rate (Optional[float]): Share of the rows changed before the
+            incremental load. Defaults to 0.1.
+        delete_rate (Optional[float]): Share of the rows deleted before the
+            incremental load. Defaults to 0.01.
+        target_url (Optional[str]): Connection string of the target, whose
+            `bench` table is replaced. Defaults to a temporary SQLite file.
+        options (Optional[dict]): `TemporalTable` attributes to set.
+
+    Returns:
+        list: (load, source rows, seconds, metrics) tuples, where `metrics`
+            is the `RunMetrics.as_dict` of the load.
+
+    """
+    workdir = tempfile.mkdtemp(prefix='ttable_bench_')
+    source_url = 'sqlite:///' + os.path.join(workdir, 'source.db')
+    if target_url is None:
+        target_url = 'sqlite:///' + os.path.join(workdir, 'target.db')
+    else:
+        engine = sqlalchemy.create_engine(target_url)
+        with engine.begin() as conn:
+            conn.execute('DROP TABLE IF EXISTS bench')
+        engine.dispose()
+
+    loads = [
+        ('initial', datetime.date(2000, 1, 1),
+         make_rows(rows, width)),
+        ('incremental', datetime.date(2000, 1, 2),
+         make_rows(rows, width, change_rate, delete_rate)),
+    ]
+
+    results = list()
+    for name, asof, snapshot in loads:
+        count = write_source(source_url, snapshot, width)
+        kwargs = dict(connection_string=target_url, source_url=source_url,
+                      width=width, asof=asof)
+
+        # A fresh process per load, so its peak RSS is its own
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            start = default_timer()
+            metrics = executor.submit(_run_load,
+                                      (kwargs, options or dict())).result()
+            elapsed = default_timer() - start
+        results.append((name, count, elapsed, metrics))
+
+    return results
+
+
+def _option(text):
+    """Parses a NAME=VALUE `--option`, VALUE as a Python literal.
+    """
+    name, _, value = text.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def _print_load(name, count, elapsed, metrics):
+    rss = metrics['max_rss']
+    print('{}: {:,} source rows in {:.2f} s, {:,.0f} rows/s, peak RSS {}, '
+          '{} inserted, {} expired, {} unchanged'
+          .format(name, count, elapsed, count / elapsed,
+                  '{:.1f} MiB'.format(rss / 2 ** 20) if rss else 'n/a',
+                  metrics['inserted'], metrics['expired'],
+                  metrics['unchanged']))
+    print('  {:<10} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'phase', 'wall s', 'cpu s', 'rows', 'rows/s', 'peak MiB'))
+    for phase, stats in metrics['phases'].items():
+        rss = stats['max_rss']
+        print('  {:<10} {:>10.3f} {:>10.3f} {:>10,} {:>12,.0f} {:>10}'.format(
+            phase, stats['wall'], stats['cpu'], stats['rows'],
+            stats['rows_per_sec'] or 0,
+            '{:.1f}'.format(rss / 2 ** 20) if rss else 'n/a'))
+
+
+def benchmark_hashes(rows, algorithms=None, repeat=3):
+    """Times `TemporalTable._digest_rows` with each hash algorithm.
+
+    Args:
+        rows (list): Rows to hash.
+        algorithms (Optional[list]): Algorithms to compare. Defaults to every
+            backend in `ttable.HASH_BACKENDS`, the frame algorithms and
+            'sha256'.
+        repeat (Optional[int]): The best of `repeat` runs is reported.
+
+    Returns:
+        list: (algorithm, seconds, digest size) tuples, fastest first.
+
+    """
+    if algorithms is None:
+        algorithms = (sorted(ttable.HASH_BACKENDS) +
+                      list(ttable.FRAME_HASH_ALGORITHMS) + ['sha256'])
+
+    task = BenchTable()
+    results = list()
+    for algorithm in algorithms:
+        task.hash_algorithm = algorithm
+        best = None
+        for _ in range(repeat):
+            start = default_timer()
+            for i in range(0, len(rows), task.chunksize):
+                digests = task._digest_rows(rows[i:i + task.chunksize])
+            elapsed = default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((algorithm, best, len(digests[0])))
+
+    return sorted(results, key=lambda result: result[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=['hashes', 'load'])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--width', type=int, default=4)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    parser.add_argument('--delete-rate', type=float, default=0.01)
+    parser.add_argument('--target-url')
+    parser.add_argument('--option', type=_option, action='append',
+                        default=[], metavar='NAME=VALUE')
+    args = parser.parse_args()
+
+    # The amounts of `make_row` have two decimals, which SQLite stores
+    # exactly enough as floats.
+    warnings.filterwarnings('ignore', 'Dialect sqlite.* Decimal',
+                            sqlalchemy.exc.SAWarning)
+
+    if args.benchmark == 'load':
+        results = benchmark_load(args.rows, args.width, args.change_rate,
+                                 args.delete_rate, args.target_url,
+                                 dict(args.option))
+        for result in results:
+            _print_load(*result)
+        return
+
+    rng = random.Random(0)
+    rows = [make_row(i, args.width, rng) for i in range(args.rows)]
+
+    print('{:<10} {:>12} {:>10} {:>7}'.format('algorithm', 'rows/s',
+                                               'us/row', 'bytes'))
+    for algorithm, elapsed, size in benchmark_hashes(rows):
+        print('{:<10} {:>12,.0f} {:>10.2f} {:>7}'
+              .format(algorithm, len(rows) / elapsed,
+                      elapsed / len(rows) * 1e6, size))
+
+
+if __name__ == '__main__':
+    main()